@@ -1,47 +1,66 @@
 import asyncio
+import logging
 from pathlib import Path
+from dataclasses import replace
 from html import escape as h
 
 from aiogram import Router, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 
-from sqlalchemy import select, func
+from sqlalchemy import select, tuple_
 
-from texts import t
+from texts import t, SCREEN_MAP
 from config_service import btn_text_cached, set_btn_text, del_btn_text, load_button_overrides
+from config_service import content_override_cached, set_content_text, del_content_override
 
 from settings import settings
-from db import get_session, User, ContentOverride
+from db import (
+    get_session, User, FunnelCounter, recompute_total_deposits, rebuild_funnel_counters, USER_CACHE,
+)
+from write_behind import WRITE_BEHIND
+from media_cache import forget as forget_media
+from broadcast import start_broadcast, last_job_stats
+from subscription import reconcile_subscriptions
+from experiments import parse_arms, current_arms, ref_link
+from analytics import parse_period, daily_funnel
 from admin_keyboards import (
     kb_admin_menu, kb_users_list, kb_user_card, kb_links_menu,
     kb_content_lang, kb_content_screens, kb_content_editor,
-    kb_params, kb_broadcast, kb_number_back
+    kb_params, kb_broadcast, kb_number_back, kb_daily_periods
 )
 from config_service import (
     set_value, get_value, set_bool,
     pb_secret, ref_reg_a, ref_dep_a, channel_id, channel_url, support_url,
     platinum_threshold, first_deposit_min,
     bcast_text, bcast_photo, set_bcast_text, set_bcast_photo,
+    ensure_config,
     check_subscription_enabled, check_registration_enabled, check_deposit_enabled,
 )
 
 router = Router(name="admin")
 
+log = logging.getLogger(__name__)
+
+# ссылки на фоновые задачи админки, чтобы их не собрал GC
+BACKGROUND: set = set()
+
+
+def _background_done(task: asyncio.Task) -> None:
+    BACKGROUND.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("admin background task failed", exc_info=task.exception())
+
 
 # --- helpers
 
 async def _render_content_screen(c: CallbackQuery, lang: str, screen: str):
     title_key, text_key = SCREEN_MAP.get(screen, ('main_title', 'main_desc'))
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-    title = ov.title if ov and ov.title else title_key
-    text = ov.text if ov and ov.text else text_key
+    ov_title, ov_text = content_override_cached(lang, screen)
+    title = ov_title or title_key
+    text = ov_text or text_key
     msg = (f"🧩 Контент — <b>{screen}</b> [{lang.upper()}]\n\n"
            f"<b>Заголовок:</b> <code>{h(title)}</code>\n<b>Текст:</b>\n<code>{h(text)[:900]}</code>")
     await c.message.edit_text(msg, reply_markup=kb_content_editor(lang, screen), parse_mode='HTML')
@@ -85,39 +104,112 @@ async def cb_menu(c: CallbackQuery):
 
 # --- users (only group A, B never shown)
 PER_PAGE = 20
+# /find: пачка одного запроса и сколько пачек на условие максимум (группу фильтруем в Python)
+FIND_BATCH = 100
+FIND_MAX_BATCHES = 50
+
+
+def _user_label(u: User) -> str:
+    r = '✅' if u.is_registered else '❌'
+    d = '✅' if u.has_deposit else '❌'
+    p = '💎' if u.is_platinum else ''
+    return f"{u.telegram_id}  R:{r}  D:{d}  {p}"
+
 
 @router.callback_query(F.data.startswith("adm:users:"))
 async def cb_users(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         return
-    page = max(1, int(c.data.split(":")[2]))
-    offset = (page - 1) * PER_PAGE
+    # adm:users:<страница>[:a<id>|:b<id>] — keyset по индексу (group_ab, id), без OFFSET:
+    # любая страница — один проход по индексу на PER_PAGE + 1 строк
+    parts = c.data.split(":")
+    page = max(1, int(parts[2]))
+    cursor = parts[3] if len(parts) > 3 else ""
+    backward = cursor.startswith("b")
 
-    async with get_session() as session:
-        total = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A'))
-        result = await session.execute(
-            select(User).where(User.group_ab == 'A').order_by(User.id.desc()).offset(offset).limit(PER_PAGE)
-        )
-        rows = result.scalars().all()
+    stmt = select(User).where(User.group_ab == 'A')
+    if cursor:
+        edge = int(cursor[1:])
+        stmt = stmt.where(User.id > edge) if backward else stmt.where(User.id < edge)
+    stmt = stmt.order_by(User.id.asc() if backward else User.id.desc()).limit(PER_PAGE + 1)
 
-    items = []
-    for u in rows:
-        r = '✅' if u.is_registered else '❌'
-        d = '✅' if u.has_deposit else '❌'
-        p = '💎' if u.is_platinum else ''
-        items.append((u.telegram_id, f"{u.telegram_id}  R:{r}  D:{d}  {p}"))
+    async with get_session() as session:
+        rows = (await session.scalars(stmt)).all()
+        # общее число — из счётчиков воронки (одна строка по PK), а не count(*) на каждую страницу
+        fc = await session.get(FunnelCounter, 'A')
+
+    more = len(rows) > PER_PAGE
+    rows = rows[:PER_PAGE]
+    if backward:
+        rows.reverse()
+        # листали назад: «ещё» — это более новые строки; их нет — значит, это первая страница
+        has_prev, has_next = more, True
+        if not more:
+            page = 1
+    else:
+        has_prev, has_next = bool(cursor), more
 
-    has_prev = page > 1
-    has_next = total > offset + len(rows)
+    items = [(u.telegram_id, _user_label(u)) for u in rows]
+    prev_cursor = rows[0].id if rows and has_prev else None
+    next_cursor = rows[-1].id if rows and has_next else None
 
     await c.message.edit_text(
-        f"👤 Пользователи ({total})\nВыберите пользователя:",
-        reply_markup=kb_users_list(items, page, has_prev, has_next),
+        f"👤 Пользователи (~{fc.users if fc else 0}), стр. {page}\n"
+        "Выберите пользователя:\n\nПоиск: /find &lt;telegram_id | click_id | trader_id&gt;",
+        reply_markup=kb_users_list(items, page, prev_cursor, next_cursor),
         parse_mode='HTML'
     )
     await c.answer()
 
 
+def _prefix(col, prefix: str):
+    """col LIKE 'prefix%' диапазоном [prefix, prefix+1) — по обычному B-tree индексу в SQLite и Postgres."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (col >= prefix) & (col < upper)
+
+
+@router.message(Command("find"))
+async def cmd_find(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+    q = (command.args or "").strip()
+    if not q:
+        await m.answer("Формат: <code>/find 123456789</code> — telegram_id, начало click_id или trader_id",
+                       parse_mode='HTML')
+        return
+
+    # каждое условие — отдельный запрос по своему индексу (telegram_id, click_id, trader_id), без OR.
+    # group_ab проверяем уже в Python: с ним в WHERE SQLite берёт индекс по группе и сканирует всю A.
+    # Поэтому диапазон префикса идём пачками по (колонка, id), пока страница не наберётся
+    searches = [(User.click_id, _prefix(User.click_id, q)), (User.trader_id, _prefix(User.trader_id, q))]
+    # telegram_id — BigInteger: длинная строка цифр в него не влезет (и переполнит параметр)
+    if q.isdigit() and int(q) < 2 ** 63:
+        searches.insert(0, (User.telegram_id, User.telegram_id == int(q)))
+    found: dict = {}
+    async with get_session() as session:
+        for col, cond in searches:
+            after = None
+            for _ in range(FIND_MAX_BATCHES):
+                stmt = select(User).where(cond)
+                if after is not None:
+                    stmt = stmt.where(tuple_(col, User.id) > tuple_(*after))
+                rows = (await session.scalars(stmt.order_by(col, User.id).limit(FIND_BATCH))).all()
+                for u in rows:
+                    if u.group_ab == 'A':
+                        found.setdefault(u.id, u)
+                if len(found) >= PER_PAGE or len(rows) < FIND_BATCH:
+                    break
+                after = (getattr(rows[-1], col.key), rows[-1].id)
+            if len(found) >= PER_PAGE:
+                break
+
+    if not found:
+        await m.answer("Никого не нашёл.")
+        return
+    items = [(u.telegram_id, _user_label(u)) for u in list(found.values())[:PER_PAGE]]
+    await m.answer(f"🔎 Найдено: {len(items)}", reply_markup=kb_users_list(items, 1, None, None))
+
+
 @router.callback_query(F.data.startswith("adm:user:"))
 async def cb_user_card(c: CallbackQuery):
     if not is_admin(c.from_user.id):
@@ -150,6 +242,9 @@ async def cb_user_card(c: CallbackQuery):
                 if not u.is_platinum:
                     u.platinum_notified = False
 
+            # сброс флагов синхронный — отложенное access_notified=True не должно его перетереть
+            if not u.access_notified:
+                WRITE_BEHIND.discard(u.id, "access_notified")
             await session.commit()
 
         # fallthrough to redraw card
@@ -211,7 +306,9 @@ async def cb_postbacks(c: CallbackQuery):
         f"<code>{h(dep_repeat)}</code>\n\n"
         "• <code>click_id</code> → <i>click_id</i>\n"
         "• <code>trader_id</code> → <i>trader_id</i>\n"
-        "• <code>sumdep</code> → <i>sumdep</i>"
+        "• <code>sumdep</code> → <i>sumdep</i>\n\n"
+        "Если партнёрка передаёт ID транзакции — добавьте <code>&amp;txn_id=...</code>: "
+        "повторы постбэков отсекаются по нему точнее."
     )
 
     await c.message.edit_text(
@@ -223,6 +320,87 @@ async def cb_postbacks(c: CallbackQuery):
     await c.answer()
 
 
+@router.message(Command("recalc_deposits"))
+async def cmd_recalc_deposits(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    # total_deposits — производная от журнала постбэков, флаги — от суммы и порогов
+    need = await first_deposit_min()
+    th = await platinum_threshold()
+    async with get_session() as session:
+        await recompute_total_deposits(session, need, th)
+        await session.commit()
+    USER_CACHE.clear()
+    await m.answer("✅ Суммы депозитов пересчитаны по журналу постбэков.")
+
+
+@router.message(Command("recalc_stats"))
+async def cmd_recalc_stats(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    # счётчики воронки заново по таблице users (после ручных правок БД и т.п.)
+    async with get_session() as session:
+        await rebuild_funnel_counters(session)
+        await session.commit()
+    await m.answer("✅ Счётчики статистики пересчитаны.")
+
+
+@router.message(Command("sub_backfill"))
+async def cmd_sub_backfill(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    # разовая сверка подписок по всем пользователям — фоном, с ограничением скорости
+    await m.answer("⏳ Сверка подписок запущена…")
+
+    async def _run():
+        try:
+            checked, fixed = await reconcile_subscriptions(m.bot)
+        except Exception:
+            await m.answer("⚠️ Сверка подписок прервалась с ошибкой, подробности в логе.")
+            raise
+        await m.answer(f"✅ Сверка подписок: проверено {checked}, исправлено {fixed}.")
+
+    BACKGROUND.add(task := asyncio.create_task(_run()))
+    task.add_done_callback(_background_done)
+
+
+# --- A/B/n эксперимент (плечи и их реф-ссылки живут в Config)
+@router.message(Command("ab"))
+async def cmd_ab(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+    args = (command.args or "").strip()
+    if args:
+        try:
+            parse_arms(args)
+        except ValueError:
+            await m.answer("Формат: <code>/ab A:2,B:1,C:1</code> (плечо — одна буква, вес — целое > 0)",
+                           parse_mode='HTML')
+            return
+        await set_value("AB_ARMS", args)
+
+    await ensure_config()
+    lines = []
+    for arm, w in current_arms():
+        reg = await ref_link("reg", arm)
+        dep = await ref_link("dep", arm)
+        lines.append(f"<b>{arm}</b> — вес {w}\nreg: <code>{h(reg or '-')}</code>\ndep: <code>{h(dep or '-')}</code>")
+    await m.answer("🧪 <b>Эксперимент</b> (для новых пользователей)\n\n" + "\n\n".join(lines), parse_mode='HTML')
+
+
+@router.message(Command("ab_link"))
+async def cmd_ab_link(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+    parts = (command.args or "").split()
+    if len(parts) != 3 or parts[1].lower() not in {"reg", "dep"} or len(parts[0]) != 1:
+        await m.answer("Формат: <code>/ab_link C reg https://...</code>", parse_mode='HTML')
+        return
+    arm, kind, url = parts[0].upper(), parts[1].upper(), parts[2]
+    await set_value(f"REF_{kind}_{arm}", url)
+    await m.answer(f"✅ Ссылка {kind.lower()} для плеча {arm} сохранена.")
+
+
 # --- links (only A; prompt as new message + approval)
 class EditState(StatesGroup):
     waiting_value = State()
@@ -307,18 +485,6 @@ async def cb_content_lang(c: CallbackQuery):
     await c.message.edit_text(f"Язык: {lang.upper()}\nВыберите экран:", reply_markup=kb_content_screens(lang))
     await c.answer()
 
-SCREEN_MAP = {
-    'main': ('main_title', 'main_desc'),
-    'instruction': ('instruction_title', 'instruction_text'),
-    'subscribe': ('subscribe_title', 'subscribe_text'),
-    'register': ('register_title', 'register_text'),
-    'deposit': ('deposit_title', 'deposit_text'),
-    'access': ('access_title', 'access_text'),
-    'platinum': ('platinum_title', 'platinum_text'),
-    'admin': ('main_title', 'main_desc'),
-    'langs': ('lang_title', 'lang_title'),
-}
-
 @router.callback_query(F.data.startswith("adm:content:screen:"))
 async def cb_content_screen(c: CallbackQuery):
     if not is_admin(c.from_user.id):
@@ -332,14 +498,7 @@ async def cb_content_reset_text(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         return
     _, _, _, lang, screen = c.data.split(":")
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-        if ov:
-            await session.delete(ov)
-            await session.commit()
+    await del_content_override(lang, screen)
     await _render_content_screen(c, lang, screen)
     await c.answer("Текст сброшен к дефолту.", show_alert=False)
 
@@ -351,6 +510,7 @@ async def cb_content_reset_photo(c: CallbackQuery):
     p = Path("assets") / ("ru" if lang == "ru" else "en") / f"{screen}.jpg"
     if p.exists():
         try:
+            await forget_media(p)
             p.unlink()
             note = "Картинка удалена (будет показан дефолт, если он есть)."
         except Exception as e:
@@ -386,17 +546,7 @@ async def on_content_text(m: Message, state: FSMContext):
     lang, screen = data["lang"], data["screen"]
     text = m.text or ""
 
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-        if not ov:
-            ov = ContentOverride(lang=lang, screen=screen, text=text)
-            session.add(ov)
-        else:
-            ov.text = text
-        await session.commit()
+    await set_content_text(lang, screen, text)
 
     await m.answer("✅ Текст сохранён. /admin → Контент, чтобы посмотреть.")
     await state.clear()
@@ -424,6 +574,8 @@ async def on_content_photo(m: Message, state: FSMContext):
     path = Path("assets") / (("ru") if lang == "ru" else "en") / f"{screen}.jpg"
     path.parent.mkdir(parents=True, exist_ok=True)
     await m.bot.download(photo, destination=path)
+    # старый file_id больше не соответствует картинке
+    await forget_media(path)
     await m.answer(f"✅ Картинка сохранена: {path}")
     await state.clear()
 
@@ -511,22 +663,39 @@ class BroadcastState(StatesGroup):
     waiting_text = State()
     waiting_photo = State()
 
-BCAST_SEGMENT = {}
+def _bcast_prefs(state: FSMContext) -> FSMContext:
+    """
+    Выбранный сегмент — у каждого админа свой, в его FSM, но в отдельном слоте (destiny):
+    state.clear() на других экранах его не сбрасывает. В версионируемый Config не пишем.
+    """
+    return FSMContext(storage=state.storage, key=replace(state.key, destiny="bcast"))
+
+
+async def _bcast_segment(state: FSMContext) -> str:
+    return (await _bcast_prefs(state).get_data()).get("segment", "all")
+
 
 @router.callback_query(F.data.startswith("adm:bcast:seg:"))
-async def cb_bcast_seg(c: CallbackQuery):
+async def cb_bcast_seg(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
     seg = c.data.split(":")[-1]
-    BCAST_SEGMENT[c.from_user.id] = seg
+    await _bcast_prefs(state).update_data(segment=seg)
     await c.answer("Сегмент выбран: " + seg, show_alert=False)
 
 @router.callback_query(F.data == "adm:broadcast")
-async def cb_broadcast(c: CallbackQuery):
+async def cb_broadcast(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
-    cur = BCAST_SEGMENT.get(c.from_user.id, "all")
-    await c.message.edit_text(f"📣 Рассылка\nСегмент: {cur}", reply_markup=kb_broadcast())
+    cur = await _bcast_segment(state)
+    text = f"📣 Рассылка\nСегмент: {cur}"
+    last = await last_job_stats()
+    if last:
+        job_state = "идёт" if last.state == "running" else "завершена"
+        text += (f"\n\nПоследняя рассылка #{last.job_id} ({job_state}):\n"
+                 f"отправлено {last.sent}, ошибок {last.failed}, "
+                 f"заблокировали {last.blocked}, в очереди {last.pending}")
+    await c.message.edit_text(text, reply_markup=kb_broadcast())
     await c.answer()
 
 @router.callback_query(F.data == "adm:bcast:text")
@@ -563,38 +732,21 @@ async def on_bcast_photo(m: Message, state: FSMContext):
     await state.clear()
 
 @router.callback_query(F.data == "adm:bcast:go")
-async def cb_bcast_go(c: CallbackQuery):
+async def cb_bcast_go(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
-    seg = BCAST_SEGMENT.get(c.from_user.id, "all")
+    seg = await _bcast_segment(state)
     text = await bcast_text()
     photo = await bcast_photo()
-    count_ok = 0
-    count_err = 0
-
-    async with get_session() as session:
-        q = select(User).where(User.group_ab == 'A')  # B исключаем
-        if seg == "reg":
-            q = q.where(User.is_registered.is_(True))
-        elif seg == "dep":
-            q = q.where(User.has_deposit.is_(True))
-        elif seg == "start":
-            q = q.where(User.is_registered.is_(False), User.has_deposit.is_(False))
-        res = await session.execute(q)
-        users = res.scalars().all()
-
-    for u in users:
-        try:
-            if photo:
-                await c.bot.send_photo(u.telegram_id, photo=photo, caption=text or None)
-            else:
-                await c.bot.send_message(u.telegram_id, text or "(пусто)")
-            count_ok += 1
-        except Exception:
-            count_err += 1
-        await asyncio.sleep(0.03)
 
-    await c.answer(f"Отправлено: {count_ok}, ошибок: {count_err}", show_alert=True)
+    # рассылка идёт фоном (задание в БД), прогресс — в отдельном статус-сообщении
+    status = await c.message.answer(f"📣 Рассылка запускается…\nСегмент: {seg}")
+    job_id = await start_broadcast(c.bot, c.from_user.id, seg, text, photo, status.chat.id, status.message_id)
+    if job_id is None:
+        await status.edit_text("⏳ Предыдущая рассылка ещё идёт.")
+        await c.answer()
+        return
+    await c.answer("Рассылка запущена", show_alert=False)
 
 
 # --- stats (only group A)
@@ -602,20 +754,81 @@ async def cb_bcast_go(c: CallbackQuery):
 async def cb_stats(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         return
+    # счётчики воронки ведутся инкрементально — одна строка по PK
     async with get_session() as session:
-        total_a = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A'))
-        subs_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_subscribed.is_(True)))
-        regs_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_registered.is_(True)))
-        deps_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.has_deposit.is_(True)))
-        plats_a = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_platinum.is_(True)))
+        fc = await session.get(FunnelCounter, 'A')
 
     text = (
         "📊 <b>Статистика</b>\n\n"
-        f"Юзеров: {total_a}\n"
-        f"Подписались: {subs_a}\n"
-        f"С регой: {regs_a}\n"
-        f"С депозитом: {deps_a}\n"
-        f"Платинум: {plats_a}"
+        f"Юзеров: {fc.users if fc else 0}\n"
+        f"Подписались: {fc.subscribed if fc else 0}\n"
+        f"С регой: {fc.registered if fc else 0}\n"
+        f"С депозитом: {fc.deposited if fc else 0}\n"
+        f"Платинум: {fc.platinum if fc else 0}\n\n"
+        "Пересчитать с нуля: /recalc_stats"
     )
     await c.message.edit_text(text, reply_markup=kb_admin_menu(), parse_mode='HTML')
     await c.answer()
+
+
+# --- воронка по дням (из роллапов daily_funnel)
+def _pct(x) -> str:
+    return "—" if x is None else f"{x * 100:.1f}%"
+
+
+def _render_daily(report: dict) -> str:
+    lines = [f"📈 <b>Воронка по дням</b> ({report['from']} — {report['to']}, UTC)\n"]
+    if not report["groups"]:
+        lines.append("За период событий нет.")
+    for group, g in report["groups"].items():
+        conv = g["conversion"]
+        lines.append(
+            f"<b>{group}</b>: новых {g['users']}\n"
+            f"  подписка {g['subscribed']} ({_pct(conv['subscribed'])}), "
+            f"рега {g['registered']} ({_pct(conv['registered'])})\n"
+            f"  депозит {g['deposited']} ({_pct(conv['deposited'])}), "
+            f"платинум {g['platinum']} ({_pct(conv['platinum'])})\n"
+            f"  сумма депозитов: {g['deposit_volume']:.2f}"
+        )
+    # ряд по дням — только для коротких окон, иначе не влезет в сообщение
+    per_day: dict = {}
+    for d in report["days"]:
+        row = per_day.setdefault(d["day"], [0, 0, 0.0])
+        row[0] += d["users"]
+        row[1] += d["deposited"]
+        row[2] += d["deposit_volume"]
+    if 0 < len(per_day) <= 14:
+        lines.append("\n<code>день        нов  деп  сумма</code>")
+        for day, (users, deps, volume) in per_day.items():
+            lines.append(f"<code>{day}  {users:<4} {deps:<4} {volume:.2f}</code>")
+    return "\n".join(lines)
+
+
+@router.callback_query(F.data.startswith("adm:daily:"))
+async def cb_daily(c: CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return
+    start, end = parse_period(None, None, days=int(c.data.split(":")[2]))
+    async with get_session() as session:
+        report = await daily_funnel(session, start, end)
+    await c.message.edit_text(
+        _render_daily(report) + "\n\nПроизвольный период: /daily 2024-01-01 2024-01-31",
+        reply_markup=kb_daily_periods(), parse_mode='HTML',
+    )
+    await c.answer()
+
+
+@router.message(Command("daily"))
+async def cmd_daily(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+    parts = (command.args or "").split()
+    try:
+        start, end = parse_period(parts[0] if parts else None, parts[1] if len(parts) > 1 else None)
+    except ValueError:
+        await m.answer("Формат: <code>/daily 2024-01-01 2024-01-31</code> (UTC, не длиннее года)",
+                       parse_mode='HTML')
+        return
+    async with get_session() as session:
+        report = await daily_funnel(session, start, end)
+    await m.answer(_render_daily(report), reply_markup=kb_daily_periods(), parse_mode='HTML')
@@ -1,5 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import Iterable, Tuple, List
+from typing import Iterable, Tuple, List, Optional
 
 # -------- Меню --------
 def kb_admin_menu() -> InlineKeyboardMarkup:
@@ -10,7 +10,14 @@ def kb_admin_menu() -> InlineKeyboardMarkup:
          InlineKeyboardButton(text='🔗 Ссылки', callback_data='adm:links')],
         [InlineKeyboardButton(text='⚙️ Параметры', callback_data='adm:params'),
          InlineKeyboardButton(text='📣 Рассылка', callback_data='adm:broadcast')],
-        [InlineKeyboardButton(text='📊 Статистика', callback_data='adm:stats')],
+        [InlineKeyboardButton(text='📊 Статистика', callback_data='adm:stats'),
+         InlineKeyboardButton(text='📈 По дням', callback_data='adm:daily:7')],
+    ])
+
+def kb_daily_periods() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f'{d} дн.', callback_data=f'adm:daily:{d}') for d in (7, 30, 90)],
+        [InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')],
     ])
 
 def kb_back_menu() -> InlineKeyboardMarkup:
@@ -22,22 +29,24 @@ def kb_back_menu() -> InlineKeyboardMarkup:
 def kb_users_list(
     items: Iterable[Tuple[int, str]],
     page: int,
-    has_prev: bool,
-    has_next: bool
+    prev_cursor: Optional[int],
+    next_cursor: Optional[int],
 ) -> InlineKeyboardMarkup:
     """
     items: Iterable[Tuple[int, str]]  # (tg_id, подпись)
     ВНИМАНИЕ: сюда уже передаём список БЕЗ пользователей группы B
+    prev_cursor / next_cursor — users.id первой / последней строки страницы (None — листать некуда).
     """
     rows: List[List[InlineKeyboardButton]] = []
     for tg_id, label in items:
         rows.append([InlineKeyboardButton(text=label, callback_data=f'adm:user:{tg_id}')])
 
+    # курсор в callback_data: adm:users:<страница>:<b|a><id> — «до» / «после» этого id
     nav: List[InlineKeyboardButton] = []
-    if has_prev:
-        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'adm:users:{page-1}'))
-    if has_next:
-        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'adm:users:{page+1}'))
+    if prev_cursor is not None:
+        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'adm:users:{page-1}:b{prev_cursor}'))
+    if next_cursor is not None:
+        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'adm:users:{page+1}:a{next_cursor}'))
     if nav:
         rows.append(nav)
     rows.append([InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')])
@@ -0,0 +1,67 @@
+"""
+Аналитика воронки по дням — только из роллапов daily_funnel (users не читается).
+
+Конверсия группы за период = сумма дневных переходов / новые пользователи за тот же период.
+Это конверсия «событий в окне», а не когорты: регистрация в периоде могла прийти от
+пользователя, пришедшего раньше. На окнах от недели и больше разница мала, для A/B — одинакова.
+"""
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import DailyFunnel, FUNNEL_COLUMNS
+
+# самое длинное окно, которое отдаём за один запрос
+MAX_DAYS = 366
+STEPS = ("subscribed", "registered", "deposited", "platinum")
+
+
+def parse_period(date_from: Optional[str], date_to: Optional[str], days: int = 7) -> Tuple[date, date]:
+    """
+    Границы периода (включительно, UTC) из строк YYYY-MM-DD; по умолчанию — последние days дней.
+    ValueError при кривой дате или слишком длинном окне.
+    """
+    end = date.fromisoformat(date_to) if date_to else datetime.utcnow().date()
+    start = date.fromisoformat(date_from) if date_from else end - timedelta(days=days - 1)
+    if start > end:
+        raise ValueError("date_from > date_to")
+    if (end - start).days >= MAX_DAYS:
+        raise ValueError(f"period longer than {MAX_DAYS} days")
+    return start, end
+
+
+async def daily_funnel(session: AsyncSession, start: date, end: date) -> Dict[str, Any]:
+    """
+    Ряд по дням и итоги по группам с конверсиями за [start, end].
+    Формат — сразу под JSON: даты строками, конверсии долями (0..1).
+    """
+    rows = (await session.scalars(
+        select(DailyFunnel)
+        .where(DailyFunnel.day >= start, DailyFunnel.day <= end)
+        .order_by(DailyFunnel.day, DailyFunnel.group_ab)
+    )).all()
+
+    days = []
+    groups: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        item = {k: getattr(r, k) for k in FUNNEL_COLUMNS}
+        item["deposit_volume"] = round(float(r.deposit_volume or 0.0), 2)
+        days.append({"day": r.day.isoformat(), "group": r.group_ab, **item})
+
+        total = groups.setdefault(r.group_ab, dict.fromkeys(FUNNEL_COLUMNS, 0) | {"deposit_volume": 0.0})
+        for k, v in item.items():
+            total[k] += v
+
+    for total in groups.values():
+        users = total["users"]
+        total["deposit_volume"] = round(total["deposit_volume"], 2)
+        total["conversion"] = {k: round(total[k] / users, 4) if users else None for k in STEPS}
+
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "groups": dict(sorted(groups.items())),
+        "days": days,
+    }
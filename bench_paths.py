@@ -0,0 +1,139 @@
+"""
+Бенчмарк горячих путей на разных бэкендах БД: /pb (postback_app) и /start (бот).
+
+Telegram не трогаем: /start идёт через DbSessionMiddleware с бот-заглушкой, /pb — через
+ASGI-транспорт httpx прямо в приложение. Меряется только наш код + БД.
+
+    python bench_paths.py                                   # SQLite во временном файле
+    python bench_paths.py postgresql+asyncpg://u:p@localhost/bench   # + Postgres (таблицы пересоздаются!)
+
+Параметры пула/кэша выражений берутся из settings (DB_POOL_SIZE, DB_STATEMENT_CACHE_SIZE ...).
+
+Результаты (1 vCPU, SQLite 3.40.1 с профилем из settings, 1000 пользователей, 2000 запросов, 16 конкурентно):
+
+    backend     /pb req/s  p95, мс   /start req/s  p95, мс
+    sqlite      145-165    ~115      420-480       ~60     пул по умолчанию: 5 + 0
+    sqlite      ~160       ~540      ~470          ~115    пул 10 + 20: писатели голодают в busy-handler,
+                                                           часть /pb падает с "database is locked"
+
+Postgres в этой среде поднять было нельзя (нет пакетов), строку для него даст запуск
+с URL локального сервера; asyncpg ставится отдельно (см. requirements.txt).
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+
+class _StubBot:
+    """Минимум Bot API, который трогает /start, без сети."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _msg(self, chat_id):
+        return SimpleNamespace(message_id=next(self._ids), photo=None, chat=SimpleNamespace(id=chat_id))
+
+    async def send_photo(self, chat_id, *a, **kw):
+        return self._msg(chat_id)
+
+    async def send_message(self, chat_id, *a, **kw):
+        return self._msg(chat_id)
+
+    async def delete_message(self, *a, **kw):
+        return True
+
+
+def _pct(lat: list, q: float) -> float:
+    lat = sorted(lat)
+    return lat[min(len(lat) - 1, int(len(lat) * q))] * 1000 if lat else 0.0
+
+
+async def _timed(n: int, conc: int, one) -> tuple:
+    lat: list = []
+    sem = asyncio.Semaphore(conc)
+
+    async def run(i: int) -> None:
+        async with sem:
+            t0 = time.perf_counter()
+            await one(i)
+            lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(run(i) for i in range(n)))
+    return n / (time.perf_counter() - t0), _pct(lat, 0.95)
+
+
+async def _bench(users: int, n: int, conc: int) -> None:
+    import httpx
+    import bot
+    import cache_sync
+    import postback_app
+    from db import engine, Base, get_session, User
+    from middlewares import DbSessionMiddleware
+    from settings import settings
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    from db import init_db
+    await init_db()
+    async with get_session() as s:
+        s.add_all([User(telegram_id=10_000 + i, click_id=f"bench{i}") for i in range(users)])
+        await s.commit()
+    await cache_sync.load_all()
+
+    transport = httpx.ASGITransport(app=postback_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def pb(i: int) -> None:
+            r = await client.get("/pb", params={
+                "t": settings.PB_SECRET, "event": "dep", "click_id": f"bench{i % users}",
+                "sumdep": "10", "txn_id": f"t{i}",
+            })
+            r.raise_for_status()
+        pb_rps, pb_p95 = await _timed(n, conc, pb)
+
+    stub = _StubBot()
+    mw = DbSessionMiddleware()
+
+    async def start(i: int) -> None:
+        m = SimpleNamespace(from_user=SimpleNamespace(id=10_000 + i % users))
+        await mw(lambda e, d: bot.cmd_start(e, d["bot"], d["session"]), m, {"bot": stub})
+    st_rps, st_p95 = await _timed(n, conc, start)
+
+    await engine.dispose()
+    print(f"{pb_rps:.0f} {pb_p95:.1f} {st_rps:.0f} {st_p95:.1f}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("urls", nargs="*")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("-n", type=int, default=2000)
+    ap.add_argument("-c", type=int, default=16)
+    ap.add_argument("--worker", action="store_true")
+    args = ap.parse_args()
+
+    if args.worker:
+        asyncio.run(_bench(args.users, args.n, args.c))
+        return
+
+    urls = [f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"] + args.urls
+    print("backend     /pb req/s  p95, мс   /start req/s  p95, мс")
+    for url in urls:
+        env = dict(os.environ, DATABASE_URL=url, TOKEN_BOT=os.getenv("TOKEN_BOT") or "1:bench")
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker",
+             "--users", str(args.users), "-n", str(args.n), "-c", str(args.c)],
+            env=env, stdout=subprocess.PIPE, text=True, check=True,
+        ).stdout.split()
+        name = url.split(":", 1)[0].split("+")[0]
+        print(f"{name:<11} {out[0]:<10} {out[1]:<9} {out[2]:<13} {out[3]}")
+
+
+if __name__ == "__main__":
+    main()
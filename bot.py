@@ -5,29 +5,43 @@ import hmac, hashlib
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, FSInputFile, ChatMemberUpdated
 
 from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from settings import settings
 from db import (
-    init_db, get_session, get_or_create_user, User,
-    ensure_click_id, ContentOverride
+    init_db, get_session, use_session, get_or_create_user, load_user, User,
+    ensure_click_id, Outbox, USER_CACHE, lock_user
 )
+from middlewares import DbSessionMiddleware, UserLockMiddleware
+from keyed_lock import USER_LOCKS
+from write_behind import WRITE_BEHIND
 from texts import t
 from keyboards import (
     kb_main, kb_instruction,  # kb_lang убран
     kb_subscribe, kb_register, kb_deposit, kb_access
 )
 from admin import router as admin_router
+from media_cache import photo_input, remember, forget
+from broadcast import resume_broadcasts, run_resume_loop
+from outbox import run_outbox_worker
+from subscription import (
+    check_subscription, resolved_channel_id, remember_subscription,
+    MEMBER_STATUSES, MEMBERSHIP,
+)
 from config_service import (
-    pb_secret, channel_id, channel_url,
+    pb_secret, channel_url,
     first_deposit_min, platinum_threshold,
-    check_subscription_enabled, load_button_overrides,
-    check_registration_enabled, check_deposit_enabled, support_url
+    check_subscription_enabled,
+    check_registration_enabled, check_deposit_enabled, support_url,
+    ensure_config, cfg_bool, screen_caption
 )
+import cache_sync
 
 ASSETS = Path(__file__).parent / "assets"
 DEFAULT_LANG = "cs"  # единственный язык интерфейса
@@ -35,9 +49,10 @@ DEFAULT_LANG = "cs"  # единственный язык интерфейса
 
 # ----------------- helpers -----------------
 async def has_access_now(u: User) -> bool:
-    sub_on = await check_subscription_enabled()
-    reg_on = await check_registration_enabled()
-    dep_on = await check_deposit_enabled()
+    await ensure_config()
+    sub_on = cfg_bool("CHECK_SUBSCRIPTION", True)
+    reg_on = cfg_bool("CHECK_REGISTRATION", True)
+    dep_on = cfg_bool("CHECK_DEPOSIT", True)
     ok_sub = (not sub_on) or u.is_subscribed
     ok_reg = (not reg_on) or u.is_registered
     ok_dep = (not dep_on) or u.has_deposit
@@ -71,79 +86,86 @@ def photo_path(_lang: Optional[str], key: str) -> Optional[Path]:
 
 
 async def delete_previous(bot: Bot, chat_id: int, user: User) -> None:
-    if user.last_bot_message_id:
+    # id последнего сообщения может ещё лежать в очереди write-behind
+    last_id = WRITE_BEHIND.value(user, "last_bot_message_id")
+    if last_id:
         try:
-            await bot.delete_message(chat_id, user.last_bot_message_id)
+            await bot.delete_message(chat_id, last_id)
         except Exception:
             pass
 
 
-async def send_screen(bot: Bot, user: User, key: str, title_key: str, text_key: str, markup) -> None:
-    """Единая отправка экрана с авто-удалением предыдущего и учётом оверрайдов из админки."""
-    async with get_session() as session:
-        db_user = await session.get(User, user.id)
-        await delete_previous(bot, db_user.telegram_id, db_user)
-
-        lang = user_lang(db_user)
-        img = photo_path(lang, key)
-
-        # базовые тексты
-        title = t(lang, title_key)
-        body = t(lang, text_key)
+def _file_rejected(e: TelegramBadRequest) -> bool:
+    """BadRequest про сам файл (протухший/чужой file_id), а не про подпись или разметку."""
+    return "file" in (e.message or "").lower()
 
-        # оверрайды
-        res = await session.execute(
-            select(ContentOverride).where(ContentOverride.lang == lang, ContentOverride.screen == key)
-        )
-        ov = res.scalar_one_or_none()
-        if ov:
-            title = ov.title or title
-            body = ov.text or body
-
-        caption = f"<b>{title}</b>\n\n{body}"
-        use_photo = (img is not None) and (len(caption) <= 1024)
 
+async def send_captioned(bot: Bot, chat_id: int, img: Optional[Path], caption: str, markup) -> Message:
+    """
+    Фото с подписью, если картинка есть и подпись влезает в лимит 1024, иначе — текст.
+    Картинка уходит по file_id из media_cache; файл грузится только в первый раз.
+    """
+    if img is not None and len(caption) <= 1024:
+        photo = photo_input(img)
         try:
-            if use_photo:
+            msg = await bot.send_photo(
+                chat_id=chat_id, photo=photo,
+                caption=caption, parse_mode="HTML", reply_markup=markup
+            )
+            if not isinstance(photo, str):
+                await remember(img, msg)
+            return msg
+        except TelegramBadRequest as e:
+            # Forbidden / RetryAfter / сеть летят выше: фото тут ни при чём, а forget()
+            # сбросил бы file_id во всех процессах. Перезаливаем только отвергнутый file_id
+            if not (isinstance(photo, str) and _file_rejected(e)):
+                photo = None
+        if isinstance(photo, str):
+            await forget(img)
+            try:
                 msg = await bot.send_photo(
-                    chat_id=db_user.telegram_id, photo=FSInputFile(img),
+                    chat_id=chat_id, photo=FSInputFile(img),
                     caption=caption, parse_mode="HTML", reply_markup=markup
                 )
-            else:
-                msg = await bot.send_message(
-                    chat_id=db_user.telegram_id, text=caption,
-                    parse_mode="HTML", reply_markup=markup
-                )
-        except Exception:
-            # на всякий случай фолбэк в текст
-            msg = await bot.send_message(
-                chat_id=db_user.telegram_id, text=caption,
-                parse_mode="HTML", reply_markup=markup
-            )
+                await remember(img, msg)
+                return msg
+            except TelegramBadRequest:
+                pass
+    # текст (или фолбэк, если фото не ушло)
+    return await bot.send_message(
+        chat_id=chat_id, text=caption,
+        parse_mode="HTML", reply_markup=markup
+    )
+
+
+async def send_screen(
+    bot: Bot, user: User, key: str, title_key: str, text_key: str, markup,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    """Единая отправка экрана с авто-удалением предыдущего и учётом оверрайдов из админки."""
+    async with use_session(session) as session:
+        db_user = await load_user(session, user)
+        await delete_previous(bot, db_user.telegram_id, db_user)
 
-        db_user.last_bot_message_id = msg.message_id
-        await session.commit()
+        lang = user_lang(db_user)
+        # готовая подпись из каталога контента (дефолты + оверрайды админки)
+        cap = screen_caption(lang, key, title_key, text_key)
+        img = photo_path(lang, key) if cap.fits_photo else None
+        msg = await send_captioned(bot, db_user.telegram_id, img, cap.caption, markup)
+
+        WRITE_BEHIND.set(db_user, last_bot_message_id=msg.message_id)
 
 
-async def send_deposit_progress(bot: Bot, user: User) -> None:
+async def send_deposit_progress(bot: Bot, user: User, session: Optional[AsyncSession] = None) -> None:
     """Экран депозита + динамический прогресс (нужная сумма / внесено / осталось)."""
-    async with get_session() as session:
-        u = await session.get(User, user.id)
+    async with use_session(session) as session:
+        u = await load_user(session, user)
         await delete_previous(bot, u.telegram_id, u)
 
         lang = user_lang(u)
-        # картинка и базовые тексты (с оверрайдом из БД, если есть)
+        # картинка и подпись из каталога контента (с оверрайдом админки, если есть)
         p = photo_path(lang, "deposit")
-        title = t(lang, "deposit_title")
-        body = t(lang, "deposit_text")
-
-        res = await session.execute(
-            select(ContentOverride).where(ContentOverride.lang == lang, ContentOverride.screen == "deposit")
-        )
-        ov = res.scalar_one_or_none()
-        if ov:
-            title = ov.title or title
-            body = ov.text or body
+        cap = screen_caption(lang, "deposit", "deposit_title", "deposit_text")
 
         # прогресс
         need = await first_deposit_min()
@@ -163,44 +185,21 @@ async def send_deposit_progress(bot: Bot, user: User) -> None:
         markup = kb_deposit(lang, dep_url)
 
         # отправка
-        caption = f"<b>{title}</b>\n\n{body}{extra}"
-        use_photo = (p is not None) and (len(caption) <= 1024)
-
-        try:
-            if use_photo:
-                msg = await bot.send_photo(u.telegram_id, FSInputFile(p),
-                                           caption=caption, parse_mode="HTML", reply_markup=markup)
-            else:
-                msg = await bot.send_message(u.telegram_id, caption, parse_mode="HTML", reply_markup=markup)
-        except Exception:
-            msg = await bot.send_message(u.telegram_id, caption, parse_mode="HTML", reply_markup=markup)
-
-        u.last_bot_message_id = msg.message_id
-        await session.commit()
+        caption = f"{cap.caption}{extra}"
+        msg = await send_captioned(bot, u.telegram_id, p, caption, markup)
 
-
-async def check_subscription(bot: Bot, tg_id: int) -> bool:
-    try:
-        cid = await channel_id()
-        member = await bot.get_chat_member(cid, tg_id)
-        status = getattr(member, "status", None)
-        return status in {"member", "administrator", "creator"}
-    except TelegramForbiddenError:
-        return False
-    except Exception:
-        return False
+        WRITE_BEHIND.set(u, last_bot_message_id=msg.message_id)
 
 
-async def evaluate_and_route(bot: Bot, user: User) -> None:
+async def evaluate_and_route(bot: Bot, user: User, session: Optional[AsyncSession] = None) -> None:
     """Показывает следующий актуальный экран по воронке."""
-    async with get_session() as session:
-        u = await session.get(User, user.id)
+    async with use_session(session) as session:
+        u = await load_user(session, user)
 
         # авто-обновление подписки
         is_sub = await check_subscription(bot, u.telegram_id)
         if is_sub and not u.is_subscribed:
             u.is_subscribed = True
-            await session.commit()
 
         # 1) Подписка
         if await check_subscription_enabled():
@@ -209,7 +208,7 @@ async def evaluate_and_route(bot: Bot, user: User) -> None:
                 await send_screen(
                     bot, u, key='subscribe',
                     title_key='subscribe_title', text_key='subscribe_text',
-                    markup=kb_subscribe(user_lang(u), ch_url)
+                    markup=kb_subscribe(user_lang(u), ch_url), session=session
                 )
                 return
 
@@ -221,132 +220,191 @@ async def evaluate_and_route(bot: Bot, user: User) -> None:
                 await send_screen(
                     bot, u, key="register",
                     title_key="register_title", text_key="register_text",
-                    markup=kb_register(user_lang(u), reg_url)
+                    markup=kb_register(user_lang(u), reg_url), session=session
                 )
                 return
 
         # 3) Депозит
         if await check_deposit_enabled():
             if not u.has_deposit:
-                u = await ensure_click_id(session, u)
-                dep_url = f"{settings.PUBLIC_BASE.rstrip('/')}/d/{u.click_id}/{await make_sig('dep', u.click_id)}"
-                await send_deposit_progress(bot, u)
+                await send_deposit_progress(bot, u, session)
                 return
 
         # Platinum (защита от расхождений с постбэком)
         th = await platinum_threshold()
         if (not u.is_platinum) and (u.total_deposits >= th):
             u.is_platinum = True
-            await session.commit()
 
         # Доступ открыт — пушим один раз
-        if not u.access_notified:
-            u.access_notified = True
-            await session.commit()
+        if not WRITE_BEHIND.value(u, "access_notified"):
+            WRITE_BEHIND.set(u, access_notified=True)
             await send_screen(
                 bot, u, key="access",
                 title_key="access_title", text_key="access_text",
-                markup=kb_access(user_lang(u), vip=u.is_platinum)
+                markup=kb_access(user_lang(u), vip=u.is_platinum), session=session
             )
             return
 
 
+async def handle_outbox(bot: Bot, item: Outbox) -> None:
+    """Исполняет намерение из outbox (их кладёт /pb в postback_app)."""
+    # в очереди с апдейтами этого пользователя: иначе пуш и тап делят одно last_bot_message_id
+    async with USER_LOCKS(item.telegram_id):
+        await _handle_outbox(bot, item)
+
+
+async def _handle_outbox(bot: Bot, item: Outbox) -> None:
+    # постбэк менял строку мимо этого процесса — снимок в LRU устарел
+    USER_CACHE.invalidate(item.telegram_id)
+    async with get_session() as session:
+        await lock_user(session, item.telegram_id)
+        u = await session.get(User, item.user_id)
+        if u is None:
+            return
+        USER_CACHE.remember(u)
+
+        if item.kind == "deposit_progress":
+            await send_deposit_progress(bot, u, session)
+        elif item.kind == "route":
+            await evaluate_and_route(bot, u, session)
+        elif item.kind == "check_sub":
+            if not u.is_subscribed and await check_subscription(bot, u.telegram_id):
+                u.is_subscribed = True
+        elif item.kind == "platinum":
+            await send_screen(
+                bot, u, key="platinum",
+                title_key="platinum_title", text_key="platinum_text",
+                markup=kb_access(u.language or "ru", vip=True), session=session
+            )
+        await session.commit()
+
+
 # ----------------- router -----------------
+# сессию в хендлеры кладёт DbSessionMiddleware (одна на апдейт, коммит после хендлера)
 router = Router()
 
 
 @router.message(Command("start"))
-async def cmd_start(m: Message, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, m.from_user.id)
-
-        # Язык выбирать не нужно — фикс "cs".
-        # Сразу переходим к главному экрану/воронке.
-        can_open = await has_access_now(user)
-        sup = await support_url()  # ← из БД
-        await send_screen(
-            bot, user, key='main',
-            title_key='main_title', text_key='main_desc',
-            markup=kb_main(user_lang(user), user.is_platinum, can_open, sup)
-        )
+async def cmd_start(m: Message, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, m.from_user.id)
+    if user.is_blocked:
+        # пользователь вернулся — снова участвует в рассылках
+        user.is_blocked = False
+
+    # Язык выбирать не нужно — фикс "cs".
+    # Сразу переходим к главному экрану/воронке.
+    can_open = await has_access_now(user)
+    sup = await support_url()  # ← из БД
+    await send_screen(
+        bot, user, key='main',
+        title_key='main_title', text_key='main_desc',
+        markup=kb_main(user_lang(user), user.is_platinum, can_open, sup), session=session
+    )
 
 
 @router.callback_query(F.data == 'menu')
-async def cb_menu_user(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        can_open = await has_access_now(user)
-        sup = await support_url()  # ← из БД
-        await send_screen(
-            bot, user, key='main',
-            title_key='main_title', text_key='main_desc',
-            markup=kb_main(user_lang(user), user.is_platinum, can_open, sup)
-        )
+async def cb_menu_user(c: CallbackQuery, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, c.from_user.id)
+    can_open = await has_access_now(user)
+    sup = await support_url()  # ← из БД
+    await send_screen(
+        bot, user, key='main',
+        title_key='main_title', text_key='main_desc',
+        markup=kb_main(user_lang(user), user.is_platinum, can_open, sup), session=session
+    )
     await c.answer()
 
 
 @router.callback_query(F.data == "instructions")
-async def cb_instructions(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        await send_screen(
-            bot, user, key="instruction",
-            title_key="instruction_title", text_key="instruction_text",
-            markup=kb_instruction(user_lang(user))
-        )
+async def cb_instructions(c: CallbackQuery, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, c.from_user.id)
+    await send_screen(
+        bot, user, key="instruction",
+        title_key="instruction_title", text_key="instruction_text",
+        markup=kb_instruction(user_lang(user)), session=session
+    )
     await c.answer()
 
 
 @router.callback_query(F.data == 'get_signal')
-async def cb_get_signal(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        if await has_access_now(user):
-            await send_screen(
-                bot, user, key='access',
-                title_key='access_title', text_key='access_text',
-                markup=kb_access(user_lang(user), vip=user.is_platinum)
-            )
-        else:
-            await evaluate_and_route(bot, user)
+async def cb_get_signal(c: CallbackQuery, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, c.from_user.id)
+    if await has_access_now(user):
+        await send_screen(
+            bot, user, key='access',
+            title_key='access_title', text_key='access_text',
+            markup=kb_access(user_lang(user), vip=user.is_platinum), session=session
+        )
+    else:
+        await evaluate_and_route(bot, user, session)
     await c.answer()
 
 
 # «Я подписался» на шаге подписки
 @router.callback_query(F.data == "check_sub")
-async def on_check_subscription(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
+async def on_check_subscription(c: CallbackQuery, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, c.from_user.id)
 
-        is_sub = await check_subscription(bot, user.telegram_id)
-        if is_sub and not user.is_subscribed:
-            user.is_subscribed = True
-            await session.commit()
+    is_sub = await check_subscription(bot, user.telegram_id, fresh=True)
+    if is_sub and not user.is_subscribed:
+        user.is_subscribed = True
 
-        # двигаем дальше по воронке
-        await evaluate_and_route(bot, user)
+    # двигаем дальше по воронке
+    await evaluate_and_route(bot, user, session)
     await c.answer()
 
 
 # Кнопка регистрации из инструкции (callback)
 @router.callback_query(F.data == "btn_register")
-async def on_btn_register(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        lang = user_lang(user)
+async def on_btn_register(c: CallbackQuery, bot: Bot, session: AsyncSession):
+    user = await get_or_create_user(session, c.from_user.id)
+    lang = user_lang(user)
+
+    if user.is_registered:
+        await c.answer(t(lang, "already_registered"), show_alert=True)
+        return
+
+    user = await ensure_click_id(session, user)
+    reg_url = f"{settings.PUBLIC_BASE.rstrip('/')}/r/{user.click_id}/{await make_sig('reg', user.click_id)}"
+    await send_screen(
+        bot, user, key="register",
+        title_key="register_title", text_key="register_text",
+        markup=kb_register(lang, reg_url), session=session
+    )
+    await c.answer()
 
-        if user.is_registered:
-            await c.answer(t(lang, "already_registered"), show_alert=True)
-            return
 
-        user = await ensure_click_id(session, user)
-        reg_url = f"{settings.PUBLIC_BASE.rstrip('/')}/r/{user.click_id}/{await make_sig('reg', user.click_id)}"
-        await send_screen(
-            bot, user, key="register",
-            title_key="register_title", text_key="register_text",
-            markup=kb_register(lang, reg_url)
-        )
-    await c.answer()
+# Push-обновления членства в канале (бот должен быть админом канала)
+@router.chat_member()
+async def on_channel_member(upd: ChatMemberUpdated):
+    cid = await resolved_channel_id()
+    if not cid or upd.chat.id != cid:
+        return
+    tg_id = upd.new_chat_member.user.id
+    is_member = upd.new_chat_member.status in MEMBER_STATUSES
+    remember_subscription(cid, tg_id, is_member)
+    MEMBERSHIP.push(tg_id, is_member)
+
+
+def make_on_joined(bot: Bot):
+    async def on_joined(user_ids: list[int]) -> None:
+        """Подписались, пока ждали на шаге подписки — ведём дальше по воронке."""
+        if not await check_subscription_enabled():
+            return
+        async with get_session() as session:
+            res = await session.execute(
+                select(User).where(User.id.in_(user_ids), User.access_notified.is_(False))
+            )
+            users = res.scalars().all()
+        for u in users:
+            try:
+                async with USER_LOCKS(u.telegram_id), get_session() as session:
+                    await lock_user(session, u.telegram_id)
+                    await evaluate_and_route(bot, u, session)
+                    await session.commit()
+            except Exception:
+                pass
+    return on_joined
 
 
 @router.message(Command("whoami"))
@@ -376,15 +434,64 @@ async def cmd_whoami(m: Message):
 
 
 # ----------------- entry -----------------
-async def main() -> None:
-    await init_db()
-    await load_button_overrides()
-    dp = Dispatcher()
+def build_bot() -> Bot:
+    return Bot(token=settings.TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+
+
+def build_dispatcher(storage: Optional[BaseStorage] = None) -> Dispatcher:
+    """Один и тот же Dispatcher для polling (bot.py) и webhook (postback_app)."""
+    dp = Dispatcher(storage=storage) if storage is not None else Dispatcher()
+    # сначала очередь по пользователю, потом сессия (см. middlewares.py)
+    dp.update.outer_middleware(UserLockMiddleware())
+    dp.update.outer_middleware(DbSessionMiddleware())
     dp.include_router(router)
     dp.include_router(admin_router)
-    bot = Bot(token=settings.TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    return dp
+
+
+def start_background(bot: Bot, single_process: bool) -> list:
+    """
+    Фоновые задачи бота. Все безопасны при нескольких процессах: outbox забирает строки
+    compare-and-swap'ом, chat_member копится в своём процессе, рассылку ведёт один процесс
+    (heartbeat_at). single_process — polling: задания продолжаем сразу, без ожидания отметки.
+    """
+    tasks = [
+        # пуши, поставленные постбэками
+        asyncio.create_task(run_outbox_worker(bot, handle_outbox)),
+        # пачечная запись chat_member-событий
+        asyncio.create_task(MEMBERSHIP.run(make_on_joined(bot))),
+    ]
+    # незавершённые рассылки продолжаем с чекпоинта
+    if single_process:
+        tasks.append(asyncio.create_task(resume_broadcasts(bot, steal=True)))
+    else:
+        tasks.append(asyncio.create_task(run_resume_loop(bot)))
+    # отложенная запись last_bot_message_id / access_notified (WRITE_BEHIND=1)
+    if WRITE_BEHIND.enabled:
+        tasks.append(asyncio.create_task(WRITE_BEHIND.run()))
+    return tasks
+
+
+async def main() -> None:
+    if settings.BOT_MODE == "webhook":
+        raise SystemExit("BOT_MODE=webhook: апдейты принимает postback_app (uvicorn postback_app:app)")
+    await init_db()
+    await cache_sync.load_all()
+    sync_task = asyncio.create_task(cache_sync.run_sync_loop())
+    dp = build_dispatcher()
+    bot = build_bot()
+    # вебхук от прошлого запуска в режиме webhook не даст получать апдейты опросом
+    await bot.delete_webhook()
+    tasks = start_background(bot, single_process=True)
     print("Bot started …")
-    await dp.start_polling(bot)
+    try:
+        # chat_member приходит только если запросить его явно
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        for task in (sync_task, *tasks):
+            task.cancel()
+        await asyncio.gather(sync_task, *tasks, return_exceptions=True)
+        await WRITE_BEHIND.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,408 @@
+"""
+Фоновая рассылка: пул воркеров + общий token-bucket под лимиты Bot API.
+
+- скорость ограничена BCAST_RATE сообщений/сек на весь бот;
+- TelegramRetryAfter ставит на паузу ВСЕ воркеры на retry_after секунд и повторяет отправку;
+- TelegramForbiddenError (бот заблокирован) -> пользователь помечается is_blocked и выпадает из рассылок;
+- прогресс раз в BCAST_PROGRESS_INTERVAL секунд пишется в статус-сообщение админу.
+
+Каждая рассылка — задание в broadcast_jobs (сегмент, текст/фото, состояние, счётчики, чекпоинт)
+плюс журнал доставки broadcast_deliveries; после рестарта задание продолжается с чекпоинта.
+Процесс, который ведёт задание, обновляет heartbeat_at вместе с прогрессом; при нескольких
+процессах (webhook в uvicorn-воркерах) брошенное задание забирает тот, кто первым
+переставит устаревшую отметку (compare-and-swap).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from collections import deque
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import select, update, insert, func, true, false, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import (
+    get_session, use_session, User, BroadcastJob, BroadcastDelivery, USER_CACHE, publish_user_invalidation,
+)
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+# сколько раз повторяем одно сообщение после RetryAfter / сетевой ошибки
+MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Простой token-bucket: rate токенов в секунду, burst — ёмкость."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Flood control от Telegram: никто не шлёт, пока пауза не истечёт."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        # за время паузы токены не копятся — иначе сразу после неё уйдёт целый burst
+        self._updated = self._paused_until
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+# один лимитер на все рассылки процесса: две параллельные рассылки делят BCAST_RATE, а не удваивают его
+LIMITER = TokenBucket(settings.BCAST_RATE)
+
+
+# статусы в журнале доставки
+DELIVERY_SENT = 1
+DELIVERY_FAILED = 2
+DELIVERY_BLOCKED = 3
+
+
+@dataclass
+class BroadcastStats:
+    job_id: int
+    segment: str
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    state: str = "running"
+    # для расчёта скорости в рамках текущего запуска процесса
+    started_at: float = field(default_factory=time.monotonic)
+    done_at_start: int = 0
+
+    @classmethod
+    def from_job(cls, job: BroadcastJob) -> "BroadcastStats":
+        st = cls(job_id=job.id, segment=job.segment, total=job.total or 0,
+                 sent=job.sent or 0, failed=job.failed or 0, blocked=job.blocked or 0, state=job.state)
+        st.done_at_start = st.done
+        return st
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def pending(self) -> int:
+        return max(0, self.total - self.done)
+
+    def render(self) -> str:
+        elapsed = max(0.001, time.monotonic() - self.started_at)
+        head = "✅ Рассылка завершена" if self.state == "done" else "📣 Рассылка идёт…"
+        return (
+            f"{head} (#{self.job_id})\n"
+            f"Сегмент: {self.segment}\n\n"
+            f"Прогресс: {self.done}/{self.total}\n"
+            f"Отправлено: {self.sent}\n"
+            f"Заблокировали бота: {self.blocked}\n"
+            f"Ошибок: {self.failed}\n"
+            f"В очереди: {self.pending}\n"
+            f"Скорость: {(self.done - self.done_at_start) / elapsed:.1f} msg/s"
+        )
+
+
+# активные рассылки этого процесса: {job_id: task}; держим ссылки, чтобы таски не собрал GC
+RUNNING: Dict[int, asyncio.Task] = {}
+
+
+def segment_filter(seg: str) -> list:
+    """Условия WHERE для сегмента (только группа A, без заблокировавших бота)."""
+    # форма условий совпадает с WHERE частичных индексов ix_users_seg_* (db.py)
+    cond = [User.group_ab == 'A', User.is_blocked == false()]
+    if seg == "reg":
+        cond.append(User.is_registered == true())
+    elif seg == "dep":
+        cond.append(User.has_deposit == true())
+    elif seg == "start":
+        cond += [User.is_registered == false(), User.has_deposit == false()]
+    return cond
+
+
+async def count_audience(seg: str, session: Optional[AsyncSession] = None) -> int:
+    async with use_session(session) as s:
+        return await s.scalar(select(func.count(User.id)).where(*segment_filter(seg))) or 0
+
+
+async def iter_audience(seg: str, after_id: int = 0,
+                        batch: Optional[int] = None) -> AsyncIterator[List[Tuple[int, int]]]:
+    """
+    Аудитория потоком пачек (id, telegram_id) с keyset-пагинацией:
+    WHERE id > :last ORDER BY id LIMIT :batch. Сессия живёт только на время одной пачки,
+    ORM-объекты не создаются — память не зависит от размера сегмента.
+    """
+    batch = batch or settings.BCAST_BATCH
+    cond = segment_filter(seg)
+    last = after_id
+    while True:
+        async with get_session() as s:
+            res = await s.execute(
+                select(User.id, User.telegram_id)
+                .where(*cond, User.id > last)
+                .order_by(User.id)
+                .limit(batch)
+            )
+            rows = [(uid, tg_id) for uid, tg_id in res.all()]
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+        if len(rows) < batch:
+            return
+
+
+async def _send_one(bot: Bot, limiter: TokenBucket, tg_id: int, text: str, photo: str) -> str:
+    """Отправляет одно сообщение. Возвращает 'ok' | 'blocked' | 'error'."""
+    for _ in range(MAX_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            if photo:
+                await bot.send_photo(tg_id, photo=photo, caption=text or None)
+            else:
+                await bot.send_message(tg_id, text or "(пусто)")
+            return "ok"
+        except TelegramRetryAfter as e:
+            limiter.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception:
+            return "error"
+    return "error"
+
+
+async def _already_delivered(session, job_id: int, user_ids: List[int]) -> Set[int]:
+    res = await session.execute(
+        select(BroadcastDelivery.user_id)
+        .where(BroadcastDelivery.job_id == job_id, BroadcastDelivery.user_id.in_(user_ids))
+    )
+    return set(res.scalars().all())
+
+
+async def _flush(job_id: int, results: List[Tuple[int, int, int]], checkpoint: int) -> None:
+    """
+    Одной транзакцией: пачка строк журнала доставки, счётчики задания, чекпоинт,
+    пометка is_blocked для заблокировавших бота.
+    """
+    sent = sum(1 for _, _, st in results if st == DELIVERY_SENT)
+    failed = sum(1 for _, _, st in results if st == DELIVERY_FAILED)
+    blocked = [tg_id for _, tg_id, st in results if st == DELIVERY_BLOCKED]
+    async with get_session() as s:
+        if results:
+            await s.execute(insert(BroadcastDelivery), [
+                {"job_id": job_id, "user_id": uid, "status": st} for uid, _, st in results
+            ])
+        if blocked:
+            await s.execute(update(User).where(User.telegram_id.in_(blocked)).values(is_blocked=True))
+            await publish_user_invalidation(s, *blocked)
+        await s.execute(
+            update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                sent=BroadcastJob.sent + sent,
+                failed=BroadcastJob.failed + failed,
+                blocked=BroadcastJob.blocked + len(blocked),
+                last_user_id=checkpoint,
+                heartbeat_at=datetime.utcnow(),
+            )
+        )
+        await s.commit()
+    USER_CACHE.invalidate(*blocked)
+
+
+async def _report(bot: Bot, chat_id: int, message_id: int, stats: BroadcastStats) -> None:
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(stats.render(), chat_id=chat_id, message_id=message_id)
+    except Exception:
+        pass
+
+
+async def run_job(bot: Bot, job_id: int) -> BroadcastStats:
+    """
+    Выполняет (или продолжает после рестарта) задание рассылки.
+
+    Аудитория читается с чекпоинта last_user_id; получатели, уже записанные в журнал,
+    пропускаются. Результаты пишутся пачками, так что после падения повторно могут уйти
+    только сообщения последней незаписанной пачки.
+    """
+    async with get_session() as s:
+        job = await s.get(BroadcastJob, job_id)
+    stats = BroadcastStats.from_job(job)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=settings.BCAST_WORKERS * 4)
+
+    results: List[Tuple[int, int, int]] = []
+    # id в порядке выдачи воркерам и id с готовым результатом — для расчёта чекпоинта
+    inflight: Deque[int] = deque()
+    completed: Set[int] = set()
+    checkpoint = job.last_user_id or 0
+    flush_lock = asyncio.Lock()
+
+    async def flush() -> None:
+        nonlocal checkpoint
+        async with flush_lock:
+            chunk = results[:]
+            results.clear()
+            # чекпоинт двигаем только по непрерывному префиксу обработанных id
+            while inflight and inflight[0] in completed:
+                completed.discard(inflight[0])
+                checkpoint = inflight.popleft()
+            await _flush(job.id, chunk, checkpoint)
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                uid, tg_id = item
+                result = await _send_one(bot, LIMITER, tg_id, job.text or "", job.photo or "")
+                if result == "ok":
+                    stats.sent += 1
+                    results.append((uid, tg_id, DELIVERY_SENT))
+                elif result == "blocked":
+                    stats.blocked += 1
+                    results.append((uid, tg_id, DELIVERY_BLOCKED))
+                else:
+                    stats.failed += 1
+                    results.append((uid, tg_id, DELIVERY_FAILED))
+                completed.add(uid)
+                if len(results) >= settings.BCAST_FLUSH_EVERY:
+                    await flush()
+            finally:
+                queue.task_done()
+
+    async def reporter() -> None:
+        while True:
+            await asyncio.sleep(settings.BCAST_PROGRESS_INTERVAL)
+            await flush()
+            await _report(bot, job.status_chat_id, job.status_message_id, stats)
+
+    workers = [asyncio.create_task(worker()) for _ in range(settings.BCAST_WORKERS)]
+    progress = asyncio.create_task(reporter())
+    try:
+        # очередь ограничена — читаем следующую пачку, только когда воркеры разобрали предыдущую
+        async for rows in iter_audience(job.segment, after_id=checkpoint):
+            async with get_session() as s:
+                seen = await _already_delivered(s, job.id, [uid for uid, _ in rows])
+            for uid, tg_id in rows:
+                if uid in seen:
+                    continue
+                inflight.append(uid)
+                await queue.put((uid, tg_id))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        progress.cancel()
+        for w in workers:
+            w.cancel()
+        await flush()
+
+    async with get_session() as s:
+        await s.execute(update(BroadcastJob).where(BroadcastJob.id == job.id)
+                        .values(state="done", finished_at=datetime.utcnow()))
+        await s.commit()
+    stats.state = "done"
+    await _report(bot, job.status_chat_id, job.status_message_id, stats)
+    return stats
+
+
+def _spawn(bot: Bot, job_id: int) -> None:
+    async def _run() -> None:
+        try:
+            await run_job(bot, job_id)
+        except Exception:
+            log.exception("broadcast job %s failed", job_id)
+        finally:
+            RUNNING.pop(job_id, None)
+
+    RUNNING[job_id] = asyncio.create_task(_run())
+
+
+async def start_broadcast(bot: Bot, admin_id: int, seg: str, text: str, photo: str,
+                          status_chat_id: int, status_message_id: int) -> Optional[int]:
+    """Создаёт задание и запускает его фоном. None — у этого админа уже идёт рассылка."""
+    async with get_session() as s:
+        busy = await s.scalar(select(BroadcastJob.id).where(
+            BroadcastJob.admin_id == admin_id, BroadcastJob.state == "running"
+        ).limit(1))
+        if busy is not None:
+            return None
+        job = BroadcastJob(
+            admin_id=admin_id, segment=seg, text=text, photo=photo, state="running",
+            total=await count_audience(seg, s), heartbeat_at=datetime.utcnow(),
+            status_chat_id=status_chat_id, status_message_id=status_message_id,
+        )
+        s.add(job)
+        try:
+            await s.commit()
+        except IntegrityError:
+            # параллельный тап успел первым (частичный уникальный индекс по admin_id)
+            return None
+        job_id = job.id
+    _spawn(bot, job_id)
+    return job_id
+
+
+async def resume_broadcasts(bot: Bot, steal: bool = False) -> None:
+    """
+    Продолжает незавершённые задания с их чекпоинтов. Берёт только брошенные
+    (heartbeat_at старше BCAST_LEASE); steal=True — все, для единственного процесса бота
+    сразу после рестарта (polling), когда ждать истечения отметки незачем.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=settings.BCAST_LEASE)
+    async with get_session() as s:
+        res = await s.execute(select(BroadcastJob.id).where(BroadcastJob.state == "running"))
+        claimed = []
+        for job_id in res.scalars().all():
+            if job_id in RUNNING:
+                continue
+            cond = [BroadcastJob.id == job_id, BroadcastJob.state == "running"]
+            if not steal:
+                cond.append(or_(BroadcastJob.heartbeat_at.is_(None), BroadcastJob.heartbeat_at < stale))
+            res_claim = await s.execute(update(BroadcastJob).where(*cond).values(heartbeat_at=now))
+            if res_claim.rowcount == 1:
+                claimed.append(job_id)
+        await s.commit()
+    for job_id in claimed:
+        _spawn(bot, job_id)
+
+
+async def run_resume_loop(bot: Bot) -> None:
+    """Несколько процессов: периодически подбираем задания, брошенные упавшим соседом."""
+    while True:
+        try:
+            await resume_broadcasts(bot)
+        except Exception:
+            log.exception("broadcast resume failed")
+        await asyncio.sleep(settings.BCAST_LEASE / 2)
+
+
+async def last_job_stats() -> Optional[BroadcastStats]:
+    """Счётчики последнего задания — прямо из строки задания, без сканирования users."""
+    async with get_session() as s:
+        job = await s.scalar(select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(1))
+    return BroadcastStats.from_job(job) if job else None
@@ -0,0 +1,145 @@
+"""
+Межпроцессная инвалидация in-memory кэшей.
+
+bot.py и воркеры postback_app.py держат свои копии Config / BtnOverride / ContentOverride.
+При каждой записи админка увеличивает версию неймспейса в таблице cache_versions
+(db.bump_cache_version) в той же транзакции. Каждый процесс раз в CACHE_POLL_INTERVAL
+делает один дешёвый SELECT по cache_versions и перезагружает только изменившиеся неймспейсы.
+
+Снимки пользователей (USER_CACHE) так же снимаются по журналу user_invalidations: туда пишут
+изменения users мимо ORM (постбэк, chat_member, рассылка) в своей транзакции.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict
+
+from sqlalchemy import delete, select
+
+from db import get_session, CacheVersion, UserInvalidation, USER_CACHE
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+# {namespace: async loader}
+LOADERS: Dict[str, Callable[[], Awaitable[None]]] = {}
+# версии, до которых кэши этого процесса уже актуальны
+_SEEN: Dict[str, int] = {}
+
+_polled_at: float = 0.0
+_lock = asyncio.Lock()
+_poll_task: "asyncio.Task | None" = None
+
+# журнал инвалидаций читаем с перекрытием: транзакции коммитятся не в порядке created_at
+INVALIDATION_OVERLAP = timedelta(seconds=30)
+# столько журнал хранится; чистит любой процесс при опросе
+INVALIDATION_TTL = timedelta(minutes=10)
+_inv_read_at: "datetime | None" = None
+_inv_pruned_at: "datetime | None" = None
+
+
+def register(namespace: str, loader: Callable[[], Awaitable[None]]) -> None:
+    LOADERS[namespace] = loader
+
+
+async def _read_versions() -> Dict[str, int]:
+    async with get_session() as s:
+        res = await s.execute(select(CacheVersion.namespace, CacheVersion.version))
+        return {ns: v for ns, v in res.all()}
+
+
+async def _drain_user_invalidations() -> None:
+    """Снимает из USER_CACHE пользователей, изменённых с прошлого опроса (в т.ч. другими процессами)."""
+    global _inv_read_at, _inv_pruned_at
+    now = datetime.utcnow()
+    async with get_session() as s:
+        if _inv_read_at is not None:
+            ids = (await s.scalars(
+                select(UserInvalidation.telegram_id)
+                .where(UserInvalidation.created_at >= _inv_read_at - INVALIDATION_OVERLAP)
+                .distinct()
+            )).all()
+            USER_CACHE.invalidate(*ids)
+        if _inv_pruned_at is None or now - _inv_pruned_at >= INVALIDATION_TTL:
+            await s.execute(delete(UserInvalidation).where(UserInvalidation.created_at < now - INVALIDATION_TTL))
+            await s.commit()
+            _inv_pruned_at = now
+    _inv_read_at = now
+
+
+async def load_all() -> None:
+    """Стартовая загрузка: фиксируем текущие версии и грузим все зарегистрированные кэши."""
+    global _polled_at
+    async with _lock:
+        versions = await _read_versions()
+        for ns, loader in LOADERS.items():
+            await loader()
+            _SEEN[ns] = versions.get(ns, 0)
+        await _drain_user_invalidations()
+        _polled_at = time.monotonic()
+
+
+async def poll() -> None:
+    """Один SELECT по cache_versions; перезагружаем только то, что поменялось."""
+    global _polled_at
+    async with _lock:
+        versions = await _read_versions()
+        _polled_at = time.monotonic()
+        for ns, version in versions.items():
+            loader = LOADERS.get(ns)
+            if loader is None or _SEEN.get(ns) == version:
+                continue
+            try:
+                await loader()
+                _SEEN[ns] = version
+            except Exception:
+                log.exception("cache reload failed: %s", ns)
+        try:
+            await _drain_user_invalidations()
+        except Exception:
+            log.exception("user cache invalidation failed")
+
+
+async def maybe_poll() -> None:
+    """
+    Ленивая проверка из горячего пути: не чаще раза в CACHE_POLL_INTERVAL.
+    Опрос уходит в фон — вызывающий может держать сессию апдейта, и ждать второе
+    соединение из пула (на SQLite он маленький) здесь нельзя.
+    """
+    global _poll_task
+    if time.monotonic() - _polled_at < settings.CACHE_POLL_INTERVAL:
+        return
+    if _lock.locked() or (_poll_task is not None and not _poll_task.done()):
+        # опрос уже идёт — не ждём его
+        return
+    _poll_task = asyncio.create_task(_poll_quietly())
+
+
+async def _poll_quietly() -> None:
+    try:
+        await poll()
+    except Exception:
+        log.exception("cache sync poll failed")
+
+
+def note_local_write(namespace: str, version: int) -> None:
+    """
+    Наша же запись уже применена к локальному кэшу — не перезагружаем его повторно.
+    Если между нами вклинился другой процесс (версия прыгнула больше чем на 1), ничего не трогаем:
+    ближайший poll() перечитает неймспейс целиком.
+    """
+    if _SEEN.get(namespace, 0) == version - 1:
+        _SEEN[namespace] = version
+
+
+async def run_sync_loop() -> None:
+    """Фоновый опрос для процессов, где кэши читаются синхронно (btn_text_cached и т.п.)."""
+    while True:
+        await asyncio.sleep(settings.CACHE_POLL_INTERVAL)
+        try:
+            await poll()
+        except Exception:
+            log.exception("cache sync poll failed")
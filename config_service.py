@@ -1,29 +1,151 @@
 from __future__ import annotations
 
-from typing import Optional,Dict, Tuple
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Dict, Tuple
 from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import get_session, Config, BtnOverride
-from settings import settings
+import cache_sync
+from db import get_session, use_session, Config, BtnOverride, ContentOverride, bump_cache_version
+from settings import settings, DEFAULT_LANG
+from texts import t, SCREEN_MAP
 
 # in-memory кэш: {(lang, key): text}
 BTN_CACHE: Dict[Tuple[str, str], str] = {}
 
+# ========= снапшот таблицы Config =========
+# Вся таблица Config грузится одним SELECT и живёт в памяти процесса.
+# Чтения — синхронные dict-lookup'ы. Записи из других процессов подтягиваются через
+# cache_sync (версия неймспейса "config"), плюс страховочная перезагрузка раз в CONFIG_TTL.
+
+# сырые значения: {key: value}
+CONFIG_CACHE: Dict[str, str] = {}
+# уже распарсенные значения: {(kind, key, default): value}; сбрасываются при каждой смене версии
+_TYPED: Dict[Tuple[str, str, Any], Any] = {}
+# растёт при каждой перезагрузке/записи — по нему можно понять, что конфиг поменялся
+CONFIG_VERSION: int = 0
+
+_config_loaded_at: float = 0.0
+_config_lock = asyncio.Lock()
+_refresh_task: Optional[asyncio.Task] = None
+
+_TRUE = {"1", "true", "yes", "on"}
+
+
+def _bump_config_version() -> None:
+    global CONFIG_VERSION
+    CONFIG_VERSION += 1
+    _TYPED.clear()
+
+
+async def load_config(session: Optional[AsyncSession] = None) -> None:
+    """
+    Перечитывает всю таблицу Config одним запросом и подменяет снапшот одним присваиванием.
+    Если пока шёл SELECT, set_value этого процесса успел записать своё, — читаем ещё раз,
+    чтобы не затереть его более старой выборкой. С session читает через неё (сессия апдейта).
+    """
+    global _config_loaded_at, CONFIG_CACHE
+    for _ in range(3):
+        started = CONFIG_VERSION
+        async with use_session(session) as s:
+            res = await s.execute(select(Config.key, Config.value))
+            fresh = {k: v for k, v in res.all()}
+        if CONFIG_VERSION == started:
+            break
+    CONFIG_CACHE = fresh
+    _bump_config_version()
+    _config_loaded_at = time.monotonic()
+
+
+async def ensure_config(session: Optional[AsyncSession] = None) -> None:
+    """
+    Грузит снапшот, если он ещё не загружен или старше CONFIG_TTL; заодно опрашивает версии.
+    Загруженный, но устаревший снапшот обновляется в фоне (см. cache_sync.maybe_poll).
+    Процессы грузят снапшот на старте (cache_sync.load_all); если его всё же нет, первая
+    загрузка идёт через переданную сессию — второе соединение из пула под сессией апдейта не ждём.
+    """
+    global _refresh_task
+    await cache_sync.maybe_poll()
+    if time.monotonic() - _config_loaded_at < settings.CONFIG_TTL:
+        return
+    if _config_loaded_at:
+        if _refresh_task is None or _refresh_task.done():
+            _refresh_task = asyncio.create_task(_refresh_config())
+        return
+    async with _config_lock:
+        # пока ждали лок, снапшот мог обновить соседний корутин
+        if time.monotonic() - _config_loaded_at < settings.CONFIG_TTL:
+            return
+        await load_config(session)
+
+
+async def _refresh_config() -> None:
+    async with _config_lock:
+        if time.monotonic() - _config_loaded_at < settings.CONFIG_TTL:
+            return
+        try:
+            await load_config()
+        except Exception:
+            pass
+
+
+# — синхронные типизированные чтения из снапшота —
+
+def cfg_value(key: str, default: Optional[str] = None) -> Optional[str]:
+    return CONFIG_CACHE.get(key, default)
+
+
+def cfg_bool(key: str, default: bool) -> bool:
+    ck = ("bool", key, default)
+    if ck not in _TYPED:
+        v = CONFIG_CACHE.get(key, "1" if default else "0")
+        _TYPED[ck] = str(v).strip().lower() in _TRUE
+    return _TYPED[ck]
+
+
+def cfg_float(key: str, default: float) -> float:
+    ck = ("float", key, default)
+    if ck not in _TYPED:
+        v = CONFIG_CACHE.get(key)
+        try:
+            _TYPED[ck] = float(v) if v is not None and str(v).strip() != "" else default
+        except Exception:
+            _TYPED[ck] = default
+    return _TYPED[ck]
+
+
+def cfg_int(key: str, default: Optional[int] = None) -> Optional[int]:
+    """
+    Безопасно читает int из снапшота; если пусто — пробует взять из settings.
+    Любая нечисловая строка -> default.
+    """
+    ck = ("int", key, default)
+    if ck not in _TYPED:
+        v = CONFIG_CACHE.get(key)
+        if v is None or str(v).strip() == "":
+            v = getattr(settings, key, None)
+        try:
+            _TYPED[ck] = int(str(v).strip())
+        except (TypeError, ValueError):
+            _TYPED[ck] = default
+    return _TYPED[ck]
+
+
 # ========= базовые helpers =========
 
 async def get_value(key: str, default: Optional[str] = None) -> Optional[str]:
     """
-    Читает значение из таблицы Config. Если ключа нет — возвращает default.
+    Читает значение из снапшота Config. Если ключа нет — возвращает default.
     """
-    async with get_session() as session:
-        res = await session.execute(select(Config).where(Config.key == key))
-        row = res.scalar_one_or_none()
-        return row.value if row else default
+    await ensure_config()
+    return cfg_value(key, default)
 
 
 async def set_value(key: str, value: str) -> None:
     """
-    Пишет/обновляет значение в таблице Config.
+    Пишет/обновляет значение в таблице Config и сразу — в снапшот.
     """
     async with get_session() as session:
         res = await session.execute(select(Config).where(Config.key == key))
@@ -33,12 +155,16 @@ async def set_value(key: str, value: str) -> None:
         else:
             row = Config(key=key, value=value)
             session.add(row)
+        version = await bump_cache_version(session, "config")
         await session.commit()
+    CONFIG_CACHE[key] = value
+    _bump_config_version()
+    cache_sync.note_local_write("config", version)
 
 
 async def get_bool(key: str, default: bool) -> bool:
-    v = await get_value(key, "1" if default else "0")
-    return str(v).strip().lower() in {"1", "true", "yes", "on"}
+    await ensure_config()
+    return cfg_bool(key, default)
 
 
 async def set_bool(key: str, value: bool) -> None:
@@ -46,11 +172,8 @@ async def set_bool(key: str, value: bool) -> None:
 
 
 async def get_float(key: str, default: float) -> float:
-    v = await get_value(key, None)
-    try:
-        return float(v) if v is not None and str(v).strip() != "" else default
-    except Exception:
-        return default
+    await ensure_config()
+    return cfg_float(key, default)
 
 
 async def set_float(key: str, value: float) -> None:
@@ -59,17 +182,8 @@ async def set_float(key: str, value: float) -> None:
 
 # — вспомогательный безопасный парсер int —
 async def _get_int(key: str, default: Optional[int] = None) -> Optional[int]:
-    """
-    Безопасно читает int из Config; если пусто — пробует взять из settings.
-    Любая нечисловая строка -> default.
-    """
-    v = await get_value(key, None)
-    if v is None or str(v).strip() == "":
-        v = getattr(settings, key, None)
-    try:
-        return int(str(v).strip())
-    except (TypeError, ValueError):
-        return default
+    await ensure_config()
+    return cfg_int(key, default)
 
 
 # ========= динамические геттеры, которые учитывают overrides из БД =========
@@ -160,13 +274,121 @@ async def set_btn_text(lang: str, key: str, value: str) -> None:
             row.text = value
         else:
             s.add(BtnOverride(lang=lang, key=key, text=value))
+        version = await bump_cache_version(s, "btn")
         await s.commit()
     BTN_CACHE[(lang, key)] = value
+    cache_sync.note_local_write("btn", version)
 
 async def del_btn_text(lang: str, key: str) -> None:
     async with get_session() as s:
         await s.execute(delete(BtnOverride).where(
             BtnOverride.lang == lang, BtnOverride.key == key
         ))
+        version = await bump_cache_version(s, "btn")
         await s.commit()
-    BTN_CACHE.pop((lang, key), None)
\ No newline at end of file
+    BTN_CACHE.pop((lang, key), None)
+    cache_sync.note_local_write("btn", version)
+
+
+
+# ========= каталог контента экранов =========
+# Дефолты из texts.T + оверрайды ContentOverride, собранные в готовые подписи.
+# Горячий путь (send_screen / send_deposit_progress / админка) в БД за контентом не ходит.
+
+PHOTO_CAPTION_LIMIT = 1024
+
+# оверрайды из БД: {(lang, screen): (title, text)}
+CONTENT_CACHE: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str]]] = {}
+
+
+@dataclass(frozen=True)
+class ScreenCaption:
+    title: str
+    body: str
+    caption: str        # "<b>title</b>\n\nbody"
+    fits_photo: bool    # влезает ли в подпись к фото
+
+
+# готовые подписи: {(lang, screen, title_key, text_key): ScreenCaption}
+CAPTION_CACHE: Dict[Tuple[str, str, str, str], ScreenCaption] = {}
+
+
+def _compile_caption(lang: str, screen: str, title_key: str, text_key: str) -> ScreenCaption:
+    title = t(lang, title_key)
+    body = t(lang, text_key)
+    ov_title, ov_text = CONTENT_CACHE.get((lang, screen), (None, None))
+    title = ov_title or title
+    body = ov_text or body
+    caption = f"<b>{title}</b>\n\n{body}"
+    return ScreenCaption(title, body, caption, len(caption) <= PHOTO_CAPTION_LIMIT)
+
+
+def screen_caption(lang: str, screen: str, title_key: str, text_key: str) -> ScreenCaption:
+    """Синхронно отдаёт готовую подпись экрана (собирается один раз и кэшируется)."""
+    ck = (lang, screen, title_key, text_key)
+    cap = CAPTION_CACHE.get(ck)
+    if cap is None:
+        cap = CAPTION_CACHE[ck] = _compile_caption(lang, screen, title_key, text_key)
+    return cap
+
+
+def content_override_cached(lang: str, screen: str) -> Tuple[Optional[str], Optional[str]]:
+    """(title, text) оверрайда из кэша; (None, None), если оверрайда нет."""
+    return CONTENT_CACHE.get((lang, screen), (None, None))
+
+
+def _recompile_screen(lang: str, screen: str) -> None:
+    for ck in [k for k in CAPTION_CACHE if k[0] == lang and k[1] == screen]:
+        CAPTION_CACHE[ck] = _compile_caption(*ck)
+
+
+async def load_content_overrides() -> None:
+    async with get_session() as s:
+        res = await s.execute(select(ContentOverride.lang, ContentOverride.screen,
+                                     ContentOverride.title, ContentOverride.text))
+        rows = res.all()
+    CONTENT_CACHE.clear()
+    for lang, screen, title, text in rows:
+        CONTENT_CACHE[(lang, screen)] = (title, text)
+    # предсобираем все известные экраны для языка бота и языков с оверрайдами
+    CAPTION_CACHE.clear()
+    langs = {DEFAULT_LANG} | {lang for lang, _ in CONTENT_CACHE}
+    for lang in langs:
+        for screen, (title_key, text_key) in SCREEN_MAP.items():
+            screen_caption(lang, screen, title_key, text_key)
+
+
+async def set_content_text(lang: str, screen: str, text: str) -> None:
+    async with get_session() as s:
+        res = await s.execute(select(ContentOverride).where(
+            ContentOverride.lang == lang, ContentOverride.screen == screen
+        ))
+        ov = res.scalar_one_or_none()
+        if not ov:
+            ov = ContentOverride(lang=lang, screen=screen, text=text)
+            s.add(ov)
+        else:
+            ov.text = text
+        title = ov.title
+        version = await bump_cache_version(s, "content")
+        await s.commit()
+    CONTENT_CACHE[(lang, screen)] = (title, text)
+    _recompile_screen(lang, screen)
+    cache_sync.note_local_write("content", version)
+
+
+async def del_content_override(lang: str, screen: str) -> None:
+    async with get_session() as s:
+        await s.execute(delete(ContentOverride).where(
+            ContentOverride.lang == lang, ContentOverride.screen == screen
+        ))
+        version = await bump_cache_version(s, "content")
+        await s.commit()
+    CONTENT_CACHE.pop((lang, screen), None)
+    _recompile_screen(lang, screen)
+    cache_sync.note_local_write("content", version)
+
+
+cache_sync.register("config", load_config)
+cache_sync.register("btn", load_button_overrides)
+cache_sync.register("content", load_content_overrides)
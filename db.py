@@ -1,16 +1,74 @@
-from datetime import datetime
-from typing import Optional
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional
 
 from sqlalchemy import (
-    BigInteger, Integer, String, Boolean, Float, Text,  # <-- добавил Text
-    select, func, UniqueConstraint
+    BigInteger, Integer, SmallInteger, String, Boolean, Float, Text, Date,  # <-- добавил Text
+    select, func, update, inspect, event, true, false, Index, UniqueConstraint
 )
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 
 from settings import settings
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False, pool_pre_ping=True)
+def engine_options(url: str) -> dict:
+    """
+    Параметры create_async_engine из settings. Пул и pre-ping — для любого бэкенда,
+    кэш подготовленных выражений — только для asyncpg.
+
+    SQLite: маленький пул без overflow. Писатели, ждущие блокировку в busy-handler, спят
+    с нарастающей паузой и на 16+ соединениях голодают дольше busy_timeout
+    ("database is locked"); очередь пула раздаёт соединения по порядку.
+    """
+    sqlite = url.startswith("sqlite")
+    if sqlite and (":memory:" in url or url.rstrip("/").endswith(":")):
+        # in-memory база живёт в одном соединении (StaticPool) — параметры пула к ней не применимы
+        return dict(echo=False)
+    pool_size = settings.DB_POOL_SIZE if settings.DB_POOL_SIZE >= 0 else (5 if sqlite else 10)
+    max_overflow = settings.DB_MAX_OVERFLOW if settings.DB_MAX_OVERFLOW >= 0 else (0 if sqlite else 20)
+    opts = dict(
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+    if url.startswith("postgresql+asyncpg"):
+        opts["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return opts
+
+
+engine = create_async_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
+
+
+def sqlite_pragmas() -> list[str]:
+    """Профиль SQLite из settings: WAL + synchronous=NORMAL, ожидание блокировки вместо ошибки, mmap и кэш страниц."""
+    if not settings.SQLITE_TUNE:
+        return []
+    return [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}",
+        f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}",
+        f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}",
+        f"PRAGMA temp_store={settings.SQLITE_TEMP_STORE}",
+    ]
+
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_conn, _record) -> None:
+        cur = dbapi_conn.cursor()
+        for pragma in sqlite_pragmas():
+            cur.execute(pragma)
+        cur.close()
+
+
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 class Base(DeclarativeBase):
@@ -41,9 +99,43 @@ class User(Base):
 
     last_bot_message_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
 
+    # бот заблокирован пользователем (TelegramForbiddenError) — исключаем из рассылок
+    is_blocked: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
 
+# Индексы под админку и рассылки (все запросы идут с group_ab == 'A'):
+# - список пользователей и общий счётчик: group_ab + ORDER BY id DESC;
+# - статистика и размер сегмента: один проход по покрывающему индексу с флагами воронки;
+# - сегменты рассылки: частичные индексы по (group_ab, id) — keyset-пачки читаются по порядку id.
+#   Условия сегментов в broadcast.segment_filter должны совпадать с WHERE индексов
+#   (== true()/false(), не IS), иначе планировщик частичный индекс не возьмёт.
+_not_blocked = User.is_blocked == false()
+Index("ix_users_group_id", User.group_ab, User.id)
+Index("ix_users_created_at", User.created_at)
+Index(
+    "ix_users_group_flags",
+    User.group_ab, User.is_subscribed, User.is_registered, User.has_deposit, User.is_platinum,
+    User.is_blocked,
+)
+Index(
+    "ix_users_seg_reg", User.group_ab, User.id,
+    sqlite_where=_not_blocked & (User.is_registered == true()),
+    postgresql_where=_not_blocked & (User.is_registered == true()),
+)
+Index(
+    "ix_users_seg_dep", User.group_ab, User.id,
+    sqlite_where=_not_blocked & (User.has_deposit == true()),
+    postgresql_where=_not_blocked & (User.has_deposit == true()),
+)
+Index(
+    "ix_users_seg_start", User.group_ab, User.id,
+    sqlite_where=_not_blocked & (User.is_registered == false()) & (User.has_deposit == false()),
+    postgresql_where=_not_blocked & (User.is_registered == false()) & (User.has_deposit == false()),
+)
+
+
 class Config(Base):
     __tablename__ = "config"
 
@@ -74,25 +166,546 @@ class BtnOverride(Base):
     )
 
 
+class MediaFile(Base):
+    """Кэш file_id Telegram для локальных картинок: ключ = путь + размер + mtime."""
+    __tablename__ = "media_files"
+
+    asset_key: Mapped[str] = mapped_column(String(512), primary_key=True)
+    path: Mapped[str] = mapped_column(String(512), index=True)
+    file_id: Mapped[str] = mapped_column(String(256), nullable=False)
+
+
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    admin_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    segment: Mapped[str] = mapped_column(String(16))
+    text: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    photo: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+    state: Mapped[str] = mapped_column(String(16), index=True, default="running")  # running / done
+
+    # чекпоинт: все получатели с id <= last_user_id уже обработаны
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+
+    status_chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    status_message_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    # отметка процесса, который ведёт задание (обновляется с прогрессом); устарела — задание брошено
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+
+# не больше одной идущей рассылки на админа: двойной тап не создаст второе задание
+Index(
+    "ix_broadcast_jobs_running_admin", BroadcastJob.admin_id, unique=True,
+    sqlite_where=BroadcastJob.state == "running",
+    postgresql_where=BroadcastJob.state == "running",
+)
+
+
+class BroadcastDelivery(Base):
+    """Журнал доставки: одна строка на получателя задания (status: 1 sent, 2 failed, 3 blocked)."""
+    __tablename__ = "broadcast_deliveries"
+
+    job_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[int] = mapped_column(SmallInteger)
+
+
+class PostbackEvent(Base):
+    """
+    Журнал постбэков (append-only). fingerprint — sha256 от (event, click_id, trader_id, amount, txn_id),
+    без txn_id — ещё и номера окна PB_DEDUP_WINDOW; уникальный индекс отсекает повторы от партнёрки. users.total_deposits = сумма amount по журналу.
+    """
+    __tablename__ = "postback_events"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64), unique=True, index=True)
+    user_id: Mapped[int] = mapped_column(Integer, index=True)
+    event: Mapped[str] = mapped_column(String(32))
+    click_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    trader_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    amount: Mapped[float] = mapped_column(Float, default=0.0)
+    txn_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
+class Outbox(Base):
+    """Намерения отправить что-то пользователю в Telegram (пишутся в транзакции постбэка)."""
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, index=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    kind: Mapped[str] = mapped_column(String(32))
+    payload: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON
+
+    state: Mapped[str] = mapped_column(String(16), index=True, default="pending")  # pending / processing / failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    locked_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
+class FsmState(Base):
+    """Состояние FSM aiogram (SqlStorage): общее для всех процессов, принимающих апдейты."""
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(160), primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    data: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON
+
+
+class UserInvalidation(Base):
+    """
+    Журнал «снимок пользователя устарел» для LRU других процессов (USER_CACHE у каждого свой).
+    Пишут изменения users мимо ORM (постбэк, chat_member, рассылка) и, при нескольких процессах
+    бота (webhook), ORM-коммиты; читает cache_sync при каждом опросе и lock_user по одному
+    пользователю.
+    """
+    __tablename__ = "user_invalidations"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        Index("ix_user_invalidations_tg_created", "telegram_id", "created_at"),
+    )
+
+
+class CacheVersion(Base):
+    """Монотонный счётчик изменений по неймспейсам кэшей (config / btn / content ...)."""
+    __tablename__ = "cache_versions"
+
+    namespace: Mapped[str] = mapped_column(String(32), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+class FunnelCounter(Base):
+    """
+    Счётчики воронки по группам A/B — статистика читается одной строкой, без COUNT по users.
+    Меняются в той же транзакции, что и флаги пользователя (см. _funnel_flips и bump_funnel).
+    """
+    __tablename__ = "funnel_counters"
+
+    group_ab: Mapped[str] = mapped_column(String(1), primary_key=True)
+    users: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    subscribed: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    registered: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    deposited: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    platinum: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+class DailyFunnel(Base):
+    """
+    Дневные роллапы воронки по группам A/B (день — по UTC): сколько пришло новых пользователей,
+    сколько флагов перевернулось за день и сумма депозитов. Пишутся там же, где FunnelCounter
+    (funnel_stmts), поэтому аналитика за любой период читается отсюда, без прохода по users.
+    Снятый флаг (отписка, правка админом) даёт -1 в день снятия — в строке нетто за день.
+    """
+    __tablename__ = "daily_funnel"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    group_ab: Mapped[str] = mapped_column(String(1), primary_key=True)
+    users: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    subscribed: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    registered: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    deposited: Mapped[int] = mapped_column(Integer, default=0, nullable=False)   # первые депозиты
+    platinum: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    deposit_volume: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+
+
+# флаг пользователя -> колонка счётчика
+FUNNEL_FLAGS = {
+    "is_subscribed": "subscribed",
+    "is_registered": "registered",
+    "has_deposit": "deposited",
+    "is_platinum": "platinum",
+}
+
+
+class UserCache:
+    """
+    Ограниченный LRU горячих пользователей: telegram_id -> снимок колонок User.
+    Наружу отдаётся не снимок, а копия, привязанная к сессии через merge(load=False) — без SELECT.
+    Write-through: изменения User через ORM после commit сами попадают в снимок (события сессии ниже).
+    Массовые UPDATE мимо ORM (постбэк, chat_member, рассылка) должны звать invalidate().
+    TTL ограничивает расхождение с изменениями из другого процесса (postback_app).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _snapshot(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        item = self._data.get(tg_id)
+        if item is None or item[0] < time.monotonic():
+            self._data.pop(tg_id, None)
+            self.misses += 1
+            return None
+        self._data.move_to_end(tg_id)
+        self.hits += 1
+        return item[1]
+
+    def remember(self, user: "User") -> None:
+        if self.maxsize <= 0 or user is None:
+            return
+        values = {k: getattr(user, k) for k in _USER_COLUMNS}
+        self._data[user.telegram_id] = (time.monotonic() + self.ttl, values)
+        self._data.move_to_end(user.telegram_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def apply(self, tg_id: int, changes: Dict[str, Any]) -> None:
+        """Накатывает закоммиченные изменения на снимок (если он есть), срок жизни не продлевает."""
+        item = self._data.get(tg_id)
+        if item is not None:
+            item[1].update(changes)
+
+    def invalidate(self, *tg_ids: int) -> None:
+        for tg_id in tg_ids:
+            self._data.pop(tg_id, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def attach(self, session: AsyncSession, tg_id: int) -> Optional["User"]:
+        """Пользователь из кэша, привязанный к сессии (или None, если в кэше его нет)."""
+        if session.info.get("locked_user") == tg_id and not session.in_transaction():
+            # снимок — только под замком пользователя (lock_user): начинаем транзакцию,
+            # after_begin берёт замок и снимает снимок, если пользователя только что писали
+            await session.connection()
+        values = self._snapshot(tg_id)
+        if values is None:
+            return None
+        user = User(**values)
+        make_transient_to_detached(user)
+        return await session.merge(user, load=False)
+
+
+_USER_COLUMNS = tuple(a.key for a in inspect(User).column_attrs)
+USER_CACHE = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+
+FUNNEL_COLUMNS = ("users", "subscribed", "registered", "deposited", "platinum")
+
+
+def funnel_stmts(group: str, deltas: Dict[str, float]) -> list:
+    """
+    UPSERT'ы на дельты {колонка: ±n}: счётчики группы за всё время и её строка за сегодня.
+    deposit_volume идёт только в дневной роллап. Пустой список, если менять нечего.
+    """
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return []
+    stmts = []
+    totals = {k: v for k, v in deltas.items() if k in FUNNEL_COLUMNS}
+    if totals:
+        table = FunnelCounter.__table__
+        stmts.append(
+            dialect_insert(FunnelCounter)
+            .values(group_ab=group, **totals)
+            .on_conflict_do_update(
+                index_elements=["group_ab"],
+                set_={k: table.c[k] + v for k, v in totals.items()},
+            )
+        )
+    daily = DailyFunnel.__table__
+    stmts.append(
+        dialect_insert(DailyFunnel)
+        .values(day=datetime.utcnow().date(), group_ab=group, **deltas)
+        .on_conflict_do_update(
+            index_elements=["day", "group_ab"],
+            set_={k: daily.c[k] + v for k, v in deltas.items()},
+        )
+    )
+    return stmts
+
+
+@event.listens_for(Session, "before_flush")
+def _funnel_flips(session, _ctx, _instances) -> None:
+    """
+    Флаги воронки, изменённые через ORM, пишутся compare-and-swap UPDATE'ом
+    (WHERE flag != new) — счётчик меняется, только если флаг в БД действительно перевернулся,
+    даже когда объект пришёл из устаревшего снимка LRU. ORM-flush эти колонки второй раз не пишет.
+    """
+    users = [
+        obj for obj in session.dirty
+        if isinstance(obj, User) and any(inspect(obj).attrs[f].history.added for f in FUNNEL_FLAGS)
+    ]
+    if not users:
+        return
+    conn = session.connection()
+    table = User.__table__
+    pending = session.info.setdefault("user_changes", {})
+    for obj in users:
+        state = inspect(obj)
+        deltas: Dict[str, int] = {}
+        for flag, counter in FUNNEL_FLAGS.items():
+            added = state.attrs[flag].history.added
+            if not added:
+                continue
+            value = bool(added[0])
+            res = conn.execute(
+                update(table).where(table.c.id == obj.id, table.c[flag] != value).values({flag: value})
+            )
+            if res.rowcount:
+                deltas[counter] = 1 if value else -1
+            set_committed_value(obj, flag, value)
+            pending.setdefault(obj.telegram_id, {})[flag] = value
+        for stmt in funnel_stmts(obj.group_ab, deltas):
+            conn.execute(stmt)
+
+
+async def bump_funnel(session: AsyncSession, group: str, deltas: Dict[str, float]) -> None:
+    """Для изменений мимо ORM (постбэк, chat_member, создание пользователя); коммит — на вызывающем."""
+    for stmt in funnel_stmts(group, deltas):
+        await session.execute(stmt)
+
+
+async def publish_user_invalidation(session: AsyncSession, *tg_ids: int) -> None:
+    """Изменения users мимо ORM: снимки этих пользователей устарели и в LRU других процессов."""
+    if tg_ids:
+        await session.execute(
+            UserInvalidation.__table__.insert(), [{"telegram_id": tg_id} for tg_id in set(tg_ids)]
+        )
+
+
+def _funnel_rebuild(sync_conn) -> None:
+    table = FunnelCounter.__table__
+    users = User.__table__
+    sync_conn.execute(table.delete())
+    sync_conn.execute(
+        table.insert().from_select(
+            ["group_ab", "users", "subscribed", "registered", "deposited", "platinum"],
+            select(
+                users.c.group_ab,
+                func.count(),
+                func.count().filter(users.c.is_subscribed == true()),
+                func.count().filter(users.c.is_registered == true()),
+                func.count().filter(users.c.has_deposit == true()),
+                func.count().filter(users.c.is_platinum == true()),
+            ).group_by(users.c.group_ab),
+        )
+    )
+
+
+def _seed_funnel_counters(sync_conn) -> None:
+    """Первый запуск со счётчиками — считаем их по users."""
+    if sync_conn.execute(select(func.count()).select_from(FunnelCounter.__table__)).scalar() == 0:
+        _funnel_rebuild(sync_conn)
+
+
+def _seed_daily_funnel(sync_conn) -> None:
+    """
+    Первый запуск с роллапами — восстанавливаем то, что есть в истории: новых пользователей
+    по users.created_at и депозиты по журналу постбэков. Когда переворачивались флаги,
+    нигде не записано — эти колонки копятся с момента появления таблицы.
+    """
+    if sync_conn.execute(select(func.count()).select_from(DailyFunnel.__table__)).scalar():
+        return
+    users = User.__table__
+    events = PostbackEvent.__table__
+    joined = func.date(users.c.created_at)
+    paid = func.date(events.c.created_at)
+    rows: Dict[tuple, Dict[str, Any]] = {}
+    for day, group, n in sync_conn.execute(
+        select(joined, users.c.group_ab, func.count()).group_by(joined, users.c.group_ab)
+    ):
+        rows.setdefault((str(day)[:10], group), {})["users"] = n
+    for day, group, volume in sync_conn.execute(
+        select(paid, users.c.group_ab, func.sum(events.c.amount))
+        .join_from(events, users, events.c.user_id == users.c.id)
+        .where(events.c.amount > 0, events.c.event != "baseline")
+        .group_by(paid, users.c.group_ab)
+    ):
+        rows.setdefault((str(day)[:10], group), {})["deposit_volume"] = float(volume)
+    if rows:
+        sync_conn.execute(DailyFunnel.__table__.insert(), [
+            {"day": date.fromisoformat(day), "group_ab": group, "users": 0, "subscribed": 0,
+             "registered": 0, "deposited": 0, "platinum": 0, "deposit_volume": 0.0, **values}
+            for (day, group), values in rows.items()
+        ])
+
+
+async def rebuild_funnel_counters(session: AsyncSession) -> None:
+    """Пересчёт счётчиков воронки с нуля по users (коммит — на вызывающем)."""
+    conn = await session.connection()
+    await conn.run_sync(_funnel_rebuild)
+
+
+# апдейты разбирают несколько процессов — ORM-изменения users тоже публикуем для чужих LRU
+_PUBLISH_ORM_USER_CHANGES = settings.BOT_MODE == "webhook"
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, _ctx) -> None:
+    pending = session.info.setdefault("user_changes", {})
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        changes = {
+            attr.key: attr.value for attr in state.attrs
+            if attr.key in _USER_COLUMNS and attr.history.has_changes()
+        }
+        if changes:
+            pending.setdefault(obj.telegram_id, {}).update(changes)
+    if _PUBLISH_ORM_USER_CHANGES:
+        # в той же транзакции, что и сами изменения; флаги воронки сюда кладёт _funnel_flips
+        published = session.info.setdefault("user_published", set())
+        fresh = [tg_id for tg_id in pending if tg_id not in published]
+        if fresh:
+            session.connection().execute(
+                UserInvalidation.__table__.insert(), [{"telegram_id": tg_id} for tg_id in fresh]
+            )
+            published.update(fresh)
+
+
+@event.listens_for(Session, "after_commit")
+def _write_through_users(session) -> None:
+    session.info.pop("user_published", None)
+    for tg_id, changes in session.info.pop("user_changes", {}).items():
+        USER_CACHE.apply(tg_id, changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_user_changes(session) -> None:
+    session.info.pop("user_published", None)
+    for tg_id in session.info.pop("user_changes", {}):
+        USER_CACHE.invalidate(tg_id)
+
+
+async def lock_user(session: AsyncSession, tg_id: int) -> None:
+    """
+    Апдейты и пуши одного пользователя — по очереди и между процессами (uvicorn-воркеры):
+    на Postgres pg_advisory_xact_lock(telegram_id) в каждой транзакции сессии до её закрытия
+    (промежуточный коммит отпускает замок, следующая транзакция берёт его снова).
+    Замок берётся с первым обращением сессии к БД или к снимку этого пользователя в LRU
+    (after_begin): апдейт, не трогающий БД, соединение не занимает. На SQLite замка нет: несколько процессов бота на SQLite порядок по
+    пользователю не держат. Вызывать до чтения пользователя; в процессе очередь держит
+    keyed_lock.USER_LOCKS.
+    """
+    if engine.dialect.name != "postgresql" and not _PUBLISH_ORM_USER_CHANGES:
+        return
+    session.info["locked_user"] = tg_id
+    if session.in_transaction():
+        # транзакция уже идёт (её after_begin был до нас) — берём сейчас
+        await session.run_sync(lambda s: _take_user_lock(s.connection(), tg_id))
+
+
+def _take_user_lock(connection, tg_id: int) -> None:
+    if connection.dialect.name == "postgresql":
+        connection.execute(select(func.pg_advisory_xact_lock(tg_id)))
+    if _PUBLISH_ORM_USER_CHANGES:
+        # другой воркер мог только что записать этого пользователя, а журнал этот процесс
+        # разберёт лишь при следующем опросе: снимок в LRU снимаем, только если запись была
+        # (старше USER_CACHE_TTL — не нужно, такие снимки LRU уже не отдаёт)
+        recent = datetime.utcnow() - timedelta(seconds=settings.USER_CACHE_TTL)
+        written = connection.execute(
+            select(UserInvalidation.id)
+            .where(UserInvalidation.telegram_id == tg_id, UserInvalidation.created_at >= recent)
+            .limit(1)
+        ).first()
+        if written:
+            USER_CACHE.invalidate(tg_id)
+
+
+@event.listens_for(Session, "after_begin")
+def _relock_user(session, _tx, connection) -> None:
+    tg_id = session.info.get("locked_user")
+    if tg_id is not None:
+        _take_user_lock(connection, tg_id)
+
+
+def _add_missing_columns(sync_conn) -> None:
+    """
+    create_all не трогает уже существующие таблицы — досоздаём новые колонки через ALTER TABLE.
+    Только добавление; у новых колонок должен быть server_default или nullable=True.
+    """
+    insp = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in existing:
+                continue
+            spec = CreateColumn(col).compile(dialect=sync_conn.dialect)
+            sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {spec}")
+
+
+def _add_missing_indexes(sync_conn) -> None:
+    """Индексы, объявленные после создания таблицы, create_all тоже не досоздаёт."""
+    insp = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {ix["name"] for ix in insp.get_indexes(table.name)}
+        for idx in table.indexes:
+            if idx.name not in existing:
+                idx.create(sync_conn)
+
+
 async def init_db() -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_add_missing_indexes)
+        await conn.run_sync(_seed_funnel_counters)
+        await conn.run_sync(_seed_daily_funnel)
 
 
 def get_session() -> AsyncSession:
     return AsyncSessionLocal()
 
 
+@asynccontextmanager
+async def use_session(session: Optional[AsyncSession] = None):
+    """
+    Сессия апдейта (коммит — на её владельце, DbSessionMiddleware) или, если её нет
+    (воркеры, фоновые задачи), своя с коммитом на выходе.
+    """
+    if session is not None:
+        yield session
+        return
+    async with get_session() as own:
+        yield own
+        await own.commit()
+
+
+def dialect_insert(model):
+    """insert() текущего диалекта — с on_conflict_do_nothing / on_conflict_do_update (SQLite и Postgres)."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+
 def gen_click_id() -> str:
     from uuid import uuid4
     return uuid4().hex
 
 
 async def ensure_click_id(session: AsyncSession, user: "User") -> "User":
+    # новый click_id фиксируем сразу: ссылка с ним уходит пользователю раньше коммита апдейта,
+    # и постбэк по ней (или упавший следом хендлер) не должен остаться без пользователя
     if not user.click_id:
         user.click_id = gen_click_id()
         await session.commit()
-        await session.refresh(user)
     return user
 
 
@@ -102,17 +715,113 @@ async def get_user_by_click_id(session: AsyncSession, click_id: str) -> Optional
 
 
 async def get_or_create_user(session: AsyncSession, tg_id: int) -> "User":
+    # горячий путь — LRU в памяти, затем один индексный SELECT
+    user = await USER_CACHE.attach(session, tg_id)
+    if user:
+        return user
     result = await session.execute(select(User).where(User.telegram_id == tg_id))
     user = result.scalar_one_or_none()
     if user:
+        USER_CACHE.remember(user)
         return user
 
-    total = await session.scalar(select(func.count(User.id)))
-    next_index = (total or 0) + 1
-    group = 'B' if (next_index % 3 == 0) else 'A'
-
-    user = User(telegram_id=tg_id, group_ab=group)
-    session.add(user)
+    # плечо эксперимента — по хэшу tg_id и весам из Config (импорт здесь: experiments зависит от db)
+    from config_service import ensure_config
+    from experiments import assign_arm
+    await ensure_config(session)
+
+    # новый пользователь: INSERT ... ON CONFLICT DO NOTHING RETURNING — параллельный /start не падает
+    stmt = (
+        dialect_insert(User)
+        .values(telegram_id=tg_id, group_ab=assign_arm(tg_id))
+        .on_conflict_do_nothing(index_elements=["telegram_id"])
+        .returning(User)
+    )
+    user = (await session.scalars(stmt)).one_or_none()
+    if user is not None:
+        await bump_funnel(session, user.group_ab, {"users": 1})
+    else:
+        # строку успел вставить соседний апдейт
+        result = await session.execute(select(User).where(User.telegram_id == tg_id))
+        user = result.scalar_one()
     await session.commit()
-    await session.refresh(user)
+    USER_CACHE.remember(user)
     return user
+
+
+async def load_user(session: AsyncSession, user: "User") -> Optional["User"]:
+    """Копия пользователя в этой сессии: сам объект, если он уже в ней; из LRU; иначе session.get()."""
+    if user in session:
+        return user
+    cached = await USER_CACHE.attach(session, user.telegram_id)
+    if cached:
+        return cached
+    fresh = await session.get(User, user.id)
+    if fresh:
+        USER_CACHE.remember(fresh)
+    return fresh
+
+
+async def bump_cache_version(session: AsyncSession, namespace: str) -> int:
+    """
+    Увеличивает версию неймспейса в текущей транзакции (коммит — на вызывающем).
+    Возвращает новую версию. Один UPSERT: первая запись нового неймспейса из двух
+    процессов сразу не падает на уникальности.
+    """
+    table = CacheVersion.__table__
+    res = await session.execute(
+        dialect_insert(CacheVersion)
+        .values(namespace=namespace, version=1)
+        .on_conflict_do_update(index_elements=["namespace"], set_={"version": table.c.version + 1})
+        .returning(CacheVersion.version)
+    )
+    return res.scalar_one()
+
+
+async def recompute_total_deposits(session: AsyncSession, need: float, th: float) -> None:
+    """
+    Пересчитывает users.total_deposits из журнала postback_events (коммит — на вызывающем).
+    Сумма сверх журнала — это депозиты до его появления: она переносится (или обновляется)
+    строкой 'baseline', чтобы пересчёт её не обнулил, даже если после запуска журнала у
+    пользователя были события. Флаги has_deposit / is_platinum поднимаются, если новая сумма
+    дотягивает до порогов need / th (не снимаются), счётчики воронки пересчитываются.
+    """
+    logged = (
+        select(func.coalesce(func.sum(PostbackEvent.amount), 0.0))
+        .where(PostbackEvent.user_id == User.id, PostbackEvent.event != "baseline")
+        .scalar_subquery()
+    )
+    res = await session.execute(
+        select(User.id, User.total_deposits - logged)
+        .where(User.total_deposits - logged > 0.005)
+    )
+    baseline = [
+        {"fingerprint": f"baseline:{uid}", "user_id": uid, "event": "baseline", "amount": float(gap)}
+        for uid, gap in res.all()
+    ]
+    if baseline:
+        stmt = dialect_insert(PostbackEvent)
+        await session.execute(
+            stmt.on_conflict_do_update(index_elements=["fingerprint"], set_={"amount": stmt.excluded.amount}),
+            baseline,
+        )
+    total = (
+        select(func.coalesce(func.sum(PostbackEvent.amount), 0.0))
+        .where(PostbackEvent.user_id == User.id)
+        .scalar_subquery()
+    )
+    await session.execute(update(User).values(total_deposits=total).execution_options(synchronize_session=False))
+    # флаги только поднимаем: снятые вручную в админке и заработанные по старому порогу не трогаем
+    await session.execute(
+        update(User)
+        .where(User.has_deposit.is_not(True), User.total_deposits >= need)
+        .values(has_deposit=True)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(User)
+        .where(User.is_platinum.is_not(True), User.total_deposits >= th)
+        .values(is_platinum=True)
+        .execution_options(synchronize_session=False)
+    )
+    await rebuild_funnel_counters(session)
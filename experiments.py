@@ -0,0 +1,78 @@
+"""
+A/B/n-эксперимент со сплитом по стабильному хэшу telegram_id.
+
+Плечи и веса задаются в Config (AB_ARMS, например "A:2,B:1,C:1"), соль — AB_SALT.
+Назначение не требует ни счётчиков, ни запросов к БД и одинаково в любом процессе;
+уже назначенные пользователи сохраняют свою группу в users.group_ab.
+Реф-ссылки плеча: Config REF_REG_<ARM> / REF_DEP_<ARM>, иначе одноимённые переменные .env.
+"""
+from __future__ import annotations
+
+import hashlib
+from typing import List, Tuple
+
+import config_service
+from config_service import cfg_value
+from settings import settings
+
+DEFAULT_ARMS = "A:2,B:1"
+
+# разобранные плечи кэшируются до следующей смены версии конфига
+_ARMS_CACHE: Tuple[int, List[Tuple[str, int]]] = (-1, [])
+
+
+def parse_arms(raw: str) -> List[Tuple[str, int]]:
+    """
+    "A:2,B:1" -> [("A", 2), ("B", 1)]. Имя плеча — одна латинская буква (users.group_ab — String(1)).
+    Мусор -> ValueError.
+    """
+    arms: List[Tuple[str, int]] = []
+    for part in (raw or "").replace(";", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, weight = part.partition(":")
+        name = name.strip().upper()
+        w = int(weight.strip() or "1")
+        if len(name) != 1 or not name.isalpha() or w <= 0:
+            raise ValueError(f"bad arm: {part!r}")
+        arms.append((name, w))
+    if not arms:
+        raise ValueError("no arms")
+    return arms
+
+
+def current_arms() -> List[Tuple[str, int]]:
+    global _ARMS_CACHE
+    version, arms = _ARMS_CACHE
+    if version != config_service.CONFIG_VERSION:
+        try:
+            arms = parse_arms(cfg_value("AB_ARMS", DEFAULT_ARMS) or DEFAULT_ARMS)
+        except ValueError:
+            arms = parse_arms(DEFAULT_ARMS)
+        _ARMS_CACHE = (config_service.CONFIG_VERSION, arms)
+    return arms
+
+
+def assign_arm(tg_id: int) -> str:
+    """Плечо для нового пользователя: sha256(соль:tg_id) по весам плеч."""
+    arms = current_arms()
+    salt = cfg_value("AB_SALT", "") or ""
+    h = int.from_bytes(hashlib.sha256(f"{salt}:{tg_id}".encode()).digest()[:8], "big")
+    bucket = h % sum(w for _, w in arms)
+    for name, w in arms:
+        if bucket < w:
+            return name
+        bucket -= w
+    return arms[0][0]
+
+
+async def ref_link(kind: str, arm: str) -> str:
+    """Реф-ссылка плеча (kind: 'reg' | 'dep'); для плеча без своей ссылки — ссылка A."""
+    await config_service.ensure_config()
+    for a in (arm or "A", "A"):
+        key = f"REF_{kind.upper()}_{a}"
+        link = cfg_value(key, None) or getattr(settings, key, "")
+        if link:
+            return link
+    return ""
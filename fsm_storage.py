@@ -0,0 +1,67 @@
+"""
+FSM-хранилище aiogram в нашей БД.
+
+MemoryStorage живёт в процессе: в режиме webhook апдейты одного админа попадают в разные
+uvicorn-воркеры, и ожидание ввода (EditState и т.п.), начатое в одном, другой не увидит.
+Здесь состояние и данные — строка fsm_states по ключу чата/пользователя.
+"""
+import json
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import use_session, dialect_insert, FsmState
+
+
+def _key(key: StorageKey) -> str:
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+        getattr(key, "business_connection_id", None) or "", key.destiny,
+    ))
+
+
+class SqlStorage(BaseStorage):
+    """
+    Без сессии каждое обращение — своя короткая транзакция (так FSMContextMiddleware читает
+    состояние до DbSessionMiddleware). Внутри апдейта хендлеры получают копию, привязанную
+    к сессии апдейта (bind): второе соединение из пула не берём, коммит — вместе с апдейтом.
+    """
+
+    def __init__(self, session: Optional[AsyncSession] = None) -> None:
+        self.session = session
+
+    def bind(self, session: AsyncSession) -> "SqlStorage":
+        return SqlStorage(session)
+
+    async def _get(self, key: StorageKey):
+        # колонками, а не s.get(): в сессии апдейта identity map не видит наш же upsert
+        async with use_session(self.session) as s:
+            res = await s.execute(select(FsmState.state, FsmState.data).where(FsmState.key == _key(key)))
+            return res.one_or_none()
+
+    async def _put(self, key: StorageKey, **values: Any) -> None:
+        async with use_session(self.session) as s:
+            await s.execute(
+                dialect_insert(FsmState).values(key=_key(key), **values)
+                .on_conflict_do_update(index_elements=["key"], set_=values)
+            )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._put(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._get(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._put(key, data=json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._get(key)
+        return json.loads(row.data) if row and row.data else {}
+
+    async def close(self) -> None:
+        pass
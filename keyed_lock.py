@@ -0,0 +1,41 @@
+"""
+Замок по ключу: корутины с одним ключом идут строго по очереди, с разными — параллельно.
+
+USER_LOCKS (ключ — telegram_id) делят UserLockMiddleware (апдейты) и пути пушей
+(handle_outbox, on_joined): иначе тап пользователя и пуш от /pb одновременно читают
+last_bot_message_id, удаляют одно и то же сообщение и шлют два экрана.
+
+asyncio.Lock отдаёт замок в порядке ожидания, поэтому апдейты одного чата выполняются в
+порядке поступления. Замок живёт в процессе: при нескольких uvicorn-воркерах (BOT_MODE=webhook)
+он упорядочивает только то, что пришло в этот воркер, а между воркерами очередь держит
+db.lock_user. Здесь он остаётся быстрым путём: в очереди за ним соединение из пула не занято.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, List
+
+
+class KeyedLock:
+    def __init__(self) -> None:
+        # ключ -> [замок, сколько корутин его держат или ждут]; запись удаляется с последней
+        self._locks: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+USER_LOCKS = KeyedLock()
@@ -0,0 +1,107 @@
+"""
+Кэш Telegram file_id для картинок экранов.
+
+Первая отправка картинки идёт файлом (FSInputFile), file_id из ответа сохраняем в media_files.
+Дальше шлём уже file_id — без повторной загрузки JPEG. Ключ включает размер и mtime файла,
+поэтому замена картинки сама по себе даёт новый ключ; админка дополнительно чистит старые записи.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Set, Union
+
+from aiogram.types import FSInputFile, Message
+from sqlalchemy import select, delete
+
+import cache_sync
+from db import get_session, MediaFile, bump_cache_version
+
+log = logging.getLogger(__name__)
+
+# {asset_key: file_id}
+FILE_ID_CACHE: Dict[str, str] = {}
+# фоновые записи в media_files; держим ссылки, чтобы таски не собрал GC
+_PENDING: Set[asyncio.Task] = set()
+# фоновые записи идут по одной в порядке постановки: forget + remember той же картинки
+# не должны поменяться местами (иначе DELETE снесёт только что сохранённый file_id)
+_WRITE_LOCK = asyncio.Lock()
+
+
+def asset_key(p: Path) -> Optional[str]:
+    try:
+        st = p.stat()
+    except OSError:
+        return None
+    return f"{p.resolve()}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def photo_input(p: Path) -> Union[str, FSInputFile]:
+    """file_id из кэша, если картинка уже загружалась, иначе — сам файл."""
+    key = asset_key(p)
+    file_id = FILE_ID_CACHE.get(key) if key else None
+    return file_id or FSInputFile(p)
+
+
+def _in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _PENDING.add(task)
+    task.add_done_callback(_PENDING.discard)
+
+
+async def _persist(key: str, path: str, file_id: str) -> None:
+    try:
+        async with _WRITE_LOCK, get_session() as s:
+            await s.merge(MediaFile(asset_key=key, path=path, file_id=file_id))
+            version = await bump_cache_version(s, "media")
+            await s.commit()
+        cache_sync.note_local_write("media", version)
+    except Exception:
+        log.exception("media_files write failed: %s", key)
+
+
+async def _delete(path: str) -> None:
+    try:
+        async with _WRITE_LOCK, get_session() as s:
+            await s.execute(delete(MediaFile).where(MediaFile.path == path))
+            version = await bump_cache_version(s, "media")
+            await s.commit()
+        cache_sync.note_local_write("media", version)
+    except Exception:
+        log.exception("media_files delete failed: %s", path)
+
+
+async def remember(p: Path, msg: Message) -> None:
+    """
+    Сохраняет file_id после первой загрузки файла. В память — сразу, в БД — фоном:
+    вызывающий обычно держит сессию апдейта, и второе соединение из пула здесь не ждём.
+    """
+    key = asset_key(p)
+    if not key or not msg.photo or key in FILE_ID_CACHE:
+        return
+    file_id = msg.photo[-1].file_id
+    FILE_ID_CACHE[key] = file_id
+    _in_background(_persist(key, str(p.resolve()), file_id))
+
+
+async def forget(p: Path) -> None:
+    """
+    Сбрасывает все file_id для пути (картинку заменили или удалили).
+    Как и remember: из памяти — сразу, из БД — фоном (вызывающий может держать сессию апдейта).
+    """
+    path = str(p.resolve())
+    for key in [k for k in FILE_ID_CACHE if k.startswith(path + ":")]:
+        FILE_ID_CACHE.pop(key, None)
+    _in_background(_delete(path))
+
+
+async def load_media_cache() -> None:
+    async with get_session() as s:
+        res = await s.execute(select(MediaFile.asset_key, MediaFile.file_id))
+        rows = res.all()
+    FILE_ID_CACHE.clear()
+    FILE_ID_CACHE.update({k: v for k, v in rows})
+
+
+cache_sync.register("media", load_media_cache)
@@ -0,0 +1,61 @@
+"""
+Middleware апдейтов aiogram.
+
+DbSessionMiddleware — unit of work: одна AsyncSession на апдейт, хендлеры получают её
+аргументом `session` и передают дальше (send_screen / evaluate_and_route ...).
+Коммит — один, после хендлера; при исключении сессия закрывается с откатом.
+Соединение берётся из пула лениво, так что апдейты без обращения к БД его не занимают.
+FSM в БД (SqlStorage) хендлеры читают и пишут через ту же сессию: state в data
+подменяется контекстом с хранилищем, привязанным к сессии апдейта.
+
+UserLockMiddleware — апдейты одного пользователя по очереди (keyed_lock.USER_LOCKS, тот же замок
+берут пуши из outbox). Регистрируется раньше DbSessionMiddleware: в очереди за замком
+соединение из пула не держим. Между процессами (webhook, несколько воркеров) очередь держит
+БД: DbSessionMiddleware первым делом берёт db.lock_user в сессии апдейта.
+"""
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.types import TelegramObject, User as TgUser
+
+from db import get_session, lock_user
+from fsm_storage import SqlStorage
+from keyed_lock import USER_LOCKS
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with get_session() as session:
+            data["session"] = session
+            user: TgUser = data.get("event_from_user")
+            if user is not None:
+                # очередь по пользователю между процессами (UserLockMiddleware — только в своём);
+                # замок возьмёт первое обращение к БД, соединение здесь ещё не занимается
+                await lock_user(session, user.id)
+            state = data.get("state")
+            if state is not None and isinstance(state.storage, SqlStorage):
+                data["state"] = FSMContext(storage=state.storage.bind(session), key=state.key)
+            result = await handler(event, data)
+            await session.commit()
+            return result
+
+
+class UserLockMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        # event_from_user кладёт UserContextMiddleware диспетчера (он стоит раньше нашего)
+        user: TgUser = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        async with USER_LOCKS(user.id):
+            return await handler(event, data)
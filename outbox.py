@@ -0,0 +1,165 @@
+"""
+Outbox для побочных эффектов в Telegram.
+
+/pb только фиксирует состояние и кладёт намерения (deposit_progress / route / check_sub / platinum)
+в таблицу outbox в той же транзакции — и сразу отвечает партнёрке. Воркер (в процессе бота
+или отдельным сайдкаром) разбирает очередь: строки одного пользователя строго по порядку id,
+разные пользователи — параллельно; ошибки — повтор с экспоненциальной паузой.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from db import get_session, Outbox, User
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Bot, Outbox], Awaitable[None]]
+
+_housekept_at: float = 0.0
+
+
+def enqueue(session: AsyncSession, user: User, kind: str, payload: Optional[Dict[str, Any]] = None) -> None:
+    """Добавляет намерение в текущую транзакцию (коммит — на вызывающем)."""
+    session.add(Outbox(
+        user_id=user.id, telegram_id=user.telegram_id, kind=kind,
+        payload=json.dumps(payload) if payload else None,
+    ))
+
+
+def payload_of(item: Outbox) -> Dict[str, Any]:
+    return json.loads(item.payload) if item.payload else {}
+
+
+async def _housekeep() -> None:
+    """
+    Раз в OUTBOX_HOUSEKEEP_INTERVAL: зависшие после падения воркера строки — обратно в очередь,
+    failed старше OUTBOX_FAILED_TTL_DAYS — удаляем. Коммит — только если что-то поменялось:
+    простаивающий бот не пишет в БД на каждом опросе.
+    """
+    global _housekept_at
+    if time.monotonic() - _housekept_at < settings.OUTBOX_HOUSEKEEP_INTERVAL:
+        return
+    _housekept_at = time.monotonic()
+    now = datetime.utcnow()
+    lease = now - timedelta(seconds=settings.OUTBOX_LEASE)
+    expired = now - timedelta(days=settings.OUTBOX_FAILED_TTL_DAYS)
+    async with get_session() as s:
+        reclaimed = await s.execute(
+            update(Outbox)
+            .where(Outbox.state == "processing", Outbox.locked_at < lease)
+            .values(state="pending", locked_at=None)
+        )
+        pruned = await s.execute(
+            delete(Outbox).where(Outbox.state == "failed", Outbox.created_at < expired)
+        )
+        if reclaimed.rowcount or pruned.rowcount:
+            await s.commit()
+
+
+async def _claim_batch() -> List[Outbox]:
+    """
+    Забирает по одной (самой ранней) строке на пользователя.
+    Пользователи, у которых строка уже в работе или самая ранняя ждёт повтора, пропускаются —
+    так сохраняется порядок внутри пользователя.
+    """
+    await _housekeep()
+    now = datetime.utcnow()
+    async with get_session() as s:
+        # готовность — в SQL: строка ждёт, срок повтора настал и перед ней у этого пользователя
+        # нет более ранней незавершённой. Иначе окно из первых N строк по id забивают строки,
+        # ждущие повтора, и свежие строки других пользователей не забираются
+        earlier = aliased(Outbox)
+        has_earlier = (
+            select(earlier.id)
+            .where(
+                earlier.telegram_id == Outbox.telegram_id,
+                earlier.id < Outbox.id,
+                earlier.state.in_(("pending", "processing")),
+            )
+            .exists()
+        )
+        res = await s.execute(
+            select(Outbox)
+            .where(Outbox.state == "pending", Outbox.next_attempt_at <= now, ~has_earlier)
+            .order_by(Outbox.id).limit(settings.OUTBOX_BATCH)
+        )
+
+        claimed: List[Outbox] = []
+        for item in res.scalars().all():
+            res = await s.execute(
+                update(Outbox)
+                .where(Outbox.id == item.id, Outbox.state == "pending")
+                .values(state="processing", locked_at=now)
+            )
+            if res.rowcount == 1:
+                claimed.append(item)
+        if claimed:
+            await s.commit()
+    return claimed
+
+
+async def _finish(item: Outbox, error: Optional[str], terminal: bool = False) -> None:
+    """Удаляет выполненную строку или планирует повтор; terminal — сразу в failed, без повторов."""
+    async with get_session() as s:
+        if error is None:
+            await s.execute(delete(Outbox).where(Outbox.id == item.id))
+        else:
+            attempts = (item.attempts or 0) + 1
+            delay = min(settings.OUTBOX_MAX_BACKOFF, 2 ** attempts)
+            await s.execute(
+                update(Outbox).where(Outbox.id == item.id).values(
+                    state="failed" if terminal or attempts >= settings.OUTBOX_MAX_ATTEMPTS else "pending",
+                    attempts=attempts,
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+                    locked_at=None,
+                    last_error=error[:1000],
+                )
+            )
+        await s.commit()
+
+
+async def drain_once(bot: Bot, handler: Handler) -> int:
+    """Один проход: забрать пачку и обработать её. Возвращает число обработанных строк."""
+    items = await _claim_batch()
+    if not items:
+        return 0
+
+    async def _one(item: Outbox) -> None:
+        try:
+            await handler(bot, item)
+        except TelegramForbiddenError as e:
+            # бот заблокирован — повторы ничего не дадут
+            await _finish(item, repr(e), terminal=True)
+        except Exception as e:
+            log.warning("outbox item %s (%s) failed: %r", item.id, item.kind, e)
+            await _finish(item, repr(e))
+        else:
+            await _finish(item, None)
+
+    await asyncio.gather(*(_one(item) for item in items))
+    return len(items)
+
+
+async def run_outbox_worker(bot: Bot, handler: Handler) -> None:
+    """Бесконечный цикл разбора outbox; спит OUTBOX_POLL_INTERVAL, когда очередь пуста."""
+    while True:
+        try:
+            done = await drain_once(bot, handler)
+        except Exception:
+            log.exception("outbox drain failed")
+            done = 0
+        if not done:
+            await asyncio.sleep(settings.OUTBOX_POLL_INTERVAL)
@@ -1,26 +1,65 @@
 # postback_app.py
-from typing import Optional
+import asyncio
+import logging
+from typing import List, Optional
 import hmac
 import hashlib
+import time
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import RedirectResponse
 
-from aiogram import Bot
-from aiogram.client.default import DefaultBotProperties
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from settings import settings
-from db import get_session, get_user_by_click_id, User
-from bot import check_subscription, send_screen, evaluate_and_route, send_deposit_progress
-from keyboards import kb_access
-from config_service import pb_secret, platinum_threshold, first_deposit_min, ref_reg_a, ref_dep_a
+import cache_sync
+from db import (
+    init_db, get_session, get_user_by_click_id, dialect_insert, bump_funnel, User, PostbackEvent,
+    publish_user_invalidation, engine,
+)
+from outbox import enqueue
+from config_service import pb_secret, platinum_threshold, first_deposit_min
+from experiments import ref_link
+from analytics import parse_period, daily_funnel
 
 
+log = logging.getLogger(__name__)
+
 app = FastAPI(title="PocketAI Postbacks")
 
-# Бот для пушей из постбэков (отдельный экземпляр, без polling)
-bot_push = Bot(token=settings.TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# Пуши в Telegram отсюда не шлём: /pb кладёт намерения в outbox, их разбирает воркер бота.
+
+
+async def _init_db_once() -> None:
+    # воркеры (и бот) стартуют одновременно: create_all соседа может успеть первым
+    for attempt in range(3):
+        try:
+            await init_db()
+            return
+        except Exception:
+            if attempt == 2:
+                raise
+            log.warning("init_db raced with another worker, retrying", exc_info=True)
+            await asyncio.sleep(1 + attempt)
+
+
+@app.on_event("startup")
+async def on_startup():
+    # таблицы могут быть ещё не созданы, если postback_app стартует раньше бота
+    await _init_db_once()
+    # кэши Config/кнопок/контента + фоновая сверка версий с другими процессами
+    await cache_sync.load_all()
+    app.state.cache_sync_task = asyncio.create_task(cache_sync.run_sync_loop())
+    if settings.BOT_MODE == "webhook":
+        await _start_webhook()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if settings.BOT_MODE == "webhook":
+        await _stop_webhook()
 
 
 # ---------- helpers: подпись редирект-ссылок ----------
@@ -65,7 +104,7 @@ async def go_reg(click_id: str, sig: str):
         if not user:
             raise HTTPException(status_code=404, detail="user not found")
 
-        base = settings.REF_REG_B if user.group_ab == "B" else (await ref_reg_a())
+        base = await ref_link("reg", user.group_ab)
         if not base:
             raise HTTPException(status_code=503, detail="ref link is not configured")
 
@@ -86,7 +125,7 @@ async def go_dep(click_id: str, sig: str):
         if not user:
             raise HTTPException(status_code=404, detail="user not found")
 
-        base = settings.REF_DEP_B if user.group_ab == "B" else (await ref_dep_a())
+        base = await ref_link("dep", user.group_ab)
         if not base:
             raise HTTPException(status_code=503, detail="ref link is not configured")
 
@@ -98,12 +137,96 @@ async def go_dep(click_id: str, sig: str):
 
 
 # ---------- приём постбэков из PP ----------
+DEPOSIT_EVENTS = {"dep_first", "dep_repeat", "deposit", "dep"}
+REG_EVENTS = {"reg", "registration"}
+
+
+async def apply_postback(session: AsyncSession, user: User, *, reg: bool, deposit: bool,
+                         amount: float, trader_id: Optional[str], need: float, th: float):
+    """
+    Переход состояния пользователя одним UPDATE ... RETURNING.
+
+    total_deposits увеличивается в самом SQL (без read-modify-write в Python), флаги считаются
+    от новой суммы там же. Текущие флаги пользователя идут в WHERE (compare-and-swap): если
+    параллельный постбэк успел их поменять, строка перечитывается и UPDATE повторяется.
+    Возвращает (old_flags, new_row).
+    """
+    for _ in range(5):
+        old = {
+            "is_registered": bool(user.is_registered),
+            "has_deposit": bool(user.has_deposit),
+            "is_platinum": bool(user.is_platinum),
+            "platinum_notified": bool(user.platinum_notified),
+        }
+        total = func.coalesce(User.total_deposits, 0.0) + amount
+        plat = or_(User.is_platinum, total >= th)
+        values = {
+            "total_deposits": total,
+            "is_platinum": plat,
+            # показать платину один раз: флаг ставим вместе с намерением в outbox
+            "platinum_notified": or_(User.platinum_notified, plat),
+        }
+        if trader_id:
+            # trader_id записываем один раз
+            values["trader_id"] = func.coalesce(User.trader_id, trader_id)
+        if reg:
+            values["is_registered"] = True
+        if deposit:
+            values["has_deposit"] = or_(User.has_deposit, total >= need)
+
+        res = await session.execute(
+            update(User)
+            .where(
+                User.id == user.id,
+                User.is_registered == old["is_registered"],
+                User.has_deposit == old["has_deposit"],
+                User.is_platinum == old["is_platinum"],
+                User.platinum_notified == old["platinum_notified"],
+            )
+            .values(**values)
+            .returning(
+                User.telegram_id, User.total_deposits, User.is_registered,
+                User.has_deposit, User.is_platinum, User.platinum_notified,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        row = res.one_or_none()
+        if row is not None:
+            return old, row
+        # флаги поменял кто-то ещё — перечитываем и пробуем снова
+        await session.refresh(user)
+    raise HTTPException(status_code=409, detail="concurrent update, retry")
+
+
+def postback_fingerprint(ev: str, click_id: str, trader_id: Optional[str],
+                         amount: float, txn_id: Optional[str], bucket: Optional[int] = None) -> str:
+    raw = f"{ev}|{click_id}|{trader_id or ''}|{amount:.2f}|{txn_id or ''}"
+    if bucket is not None:
+        raw += f"|{bucket}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def postback_fingerprints(ev: str, click_id: str, trader_id: Optional[str],
+                          amount: float, txn_id: Optional[str]) -> List[str]:
+    """
+    Ключи, по которым постбэк считается повтором; первый — ключ для записи в журнал.
+    С txn_id — один ключ навсегда. Без txn_id второй такой же депозит (dep_repeat на ту же сумму)
+    от повтора отличим только по времени: в ключ входит номер окна PB_DEDUP_WINDOW,
+    повтор ищем в текущем и прошлом окне — то есть не старше одного-двух окон.
+    """
+    if txn_id:
+        return [postback_fingerprint(ev, click_id, trader_id, amount, txn_id)]
+    bucket = int(time.time() // settings.PB_DEDUP_WINDOW)
+    return [postback_fingerprint(ev, click_id, trader_id, amount, None, b) for b in (bucket, bucket - 1)]
+
+
 @app.get("/pb")
 async def pb(
     event: Optional[str] = None,
     click_id: Optional[str] = None,
     trader_id: Optional[str] = None,
     sumdep: Optional[float] = 0.0,
+    txn_id: Optional[str] = None,
     t: Optional[str] = None,
 ):
     # секьюрность
@@ -114,93 +237,164 @@ async def pb(
     if not click_id:
         raise HTTPException(status_code=400, detail="missing click_id")
 
+    # длины как в схеме: Postgres, в отличие от SQLite, длинную строку не запишет
+    ev = (event or "").lower().strip()[:32]
+    trader_id = trader_id[:64] if trader_id else trader_id
+    txn_id = txn_id[:128] if txn_id else txn_id
+    amount = float(sumdep or 0.0)
+    deposit = ev in DEPOSIT_EVENTS or amount > 0.0
+    fps = postback_fingerprints(ev, click_id, trader_id, amount, txn_id)
+    fp = fps[0]
+    duplicate = {"ok": True, "event": event, "duplicate": True}
+    # конфиг читаем до транзакции: опрос cache_sync берёт второе соединение из пула,
+    # а с открытой записью в SQLite это взаимная блокировка до busy_timeout
+    need = await first_deposit_min()
+    th = await platinum_threshold()
+
     async with get_session() as session:
+        # повтор от партнёрки — отвечаем сразу, по уникальному индексу
+        if await session.scalar(select(PostbackEvent.id).where(PostbackEvent.fingerprint.in_(fps)).limit(1)):
+            return duplicate
+
         user: Optional[User] = await get_user_by_click_id(session, click_id)
         if not user:
             raise HTTPException(status_code=404, detail="user not found")
 
-        changed = False
-        ev = (event or "").lower().strip()
-
-        # trader_id записываем один раз
-        if trader_id and not user.trader_id:
-            user.trader_id = trader_id
-            changed = True
-
-        # регистрация
-        if ev in {"reg", "registration"}:
-            if not user.is_registered:
-                user.is_registered = True
-                changed = True
-
-        # депозиты: накапливаем total_deposits, порог сравниваем по сумме
-        amount = float(sumdep or 0.0)
-        if ev in {"dep_first", "dep_repeat", "deposit", "dep"} or amount > 0.0:
-            if amount > 0.0:
-                user.total_deposits = (user.total_deposits or 0.0) + amount
-                changed = True
-                await session.commit()  # фиксируем сумму сразу
-
-            need = await first_deposit_min()
-            paid = float(user.total_deposits or 0.0)
-
-            if paid < need:
-                # ещё не дотянули — обновляем экран прогресса депозита
-                try:
-                    await send_deposit_progress(bot_push, user)
-                except Exception:
-                    pass
+        # запись в журнал; параллельный дубль отсечёт уникальный индекс
+        res = await session.execute(
+            dialect_insert(PostbackEvent)
+            .values(fingerprint=fp, user_id=user.id, event=ev or "-", click_id=click_id,
+                    trader_id=trader_id, amount=amount, txn_id=txn_id)
+            .on_conflict_do_nothing(index_elements=["fingerprint"])
+            .returning(PostbackEvent.id)
+        )
+        if res.scalar_one_or_none() is None:
+            await session.rollback()
+            return duplicate
+
+        old, new = await apply_postback(
+            session, user, reg=ev in REG_EVENTS, deposit=deposit,
+            amount=amount, trader_id=trader_id, need=need, th=th,
+        )
+        # счётчики воронки — только по реально перевернувшимся флагам; сумма — в дневной роллап
+        await bump_funnel(session, user.group_ab, {
+            "registered": int(bool(new.is_registered) and not old["is_registered"]),
+            "deposited": int(bool(new.has_deposit) and not old["has_deposit"]),
+            "platinum": int(bool(new.is_platinum) and not old["is_platinum"]),
+            "deposit_volume": max(amount, 0.0),
+        })
+
+        # намерения для воркера outbox — в той же транзакции
+        if deposit:
+            if float(new.total_deposits or 0.0) < need:
+                # ещё не дотянули — обновим экран прогресса депозита
+                enqueue(session, user, "deposit_progress")
             else:
-                # порог достигнут — ставим флаг и ведём дальше
-                if not user.has_deposit:
-                    user.has_deposit = True
-                    changed = True
-                    await session.commit()
-                try:
-                    await evaluate_and_route(bot_push, user)
-                except Exception:
-                    pass
-
-        if changed:
-            await session.commit()
-
-        # подписка: мог обновиться статус — проверим
-        try:
-            subscribed = await check_subscription(bot_push, user.telegram_id)
-        except Exception:
-            subscribed = False
-        if subscribed and not user.is_subscribed:
-            user.is_subscribed = True
-            await session.commit()
-
-        # платина — по накопленной сумме
-        th = await platinum_threshold()
-        if (not user.is_platinum) and ((user.total_deposits or 0.0) >= th):
-            user.is_platinum = True
-            await session.commit()
-
-        # показать платину один раз
-        if user.is_platinum and (not user.platinum_notified):
-            try:
-                await send_screen(
-                    bot_push,
-                    user,
-                    key="platinum",
-                    title_key="platinum_title",
-                    text_key="platinum_text",
-                    markup=kb_access(user.language or "ru", vip=True),
-                )
-                user.platinum_notified = True
-                await session.commit()
-            except Exception:
-                pass
+                # порог достигнут — ведём дальше по воронке
+                enqueue(session, user, "route")
+        elif not user.is_subscribed:
+            # подписка могла обновиться — проверит воркер (route проверяет её сам)
+            enqueue(session, user, "check_sub")
+
+        if new.platinum_notified and not old["platinum_notified"]:
+            enqueue(session, user, "platinum")
+
+        # UPDATE шёл мимо ORM — снимок пользователя в LRU процессов бота устарел
+        await publish_user_invalidation(session, new.telegram_id)
+
+        # один коммит на постбэк: состояние + намерения в outbox + инвалидация
+        await session.commit()
 
         return {
             "ok": True,
             "event": event,
-            "telegram_id": user.telegram_id,
-            "is_registered": user.is_registered,
-            "has_deposit": user.has_deposit,
-            "total_deposits": float(user.total_deposits or 0.0),
-            "is_platinum": user.is_platinum,
+            "telegram_id": new.telegram_id,
+            "is_registered": bool(new.is_registered),
+            "has_deposit": bool(new.has_deposit),
+            "total_deposits": float(new.total_deposits or 0.0),
+            "is_platinum": bool(new.is_platinum),
         }
+
+
+# ---------- аналитика: дневные роллапы воронки ----------
+@app.get("/stats/daily")
+async def stats_daily(
+    t: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    # тот же секрет, что у /pb
+    secret = await pb_secret()
+    if not t or t != secret:
+        raise HTTPException(status_code=403, detail="forbidden")
+    try:
+        start, end = parse_period(date_from, date_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    async with get_session() as session:
+        return await daily_funnel(session, start, end)
+
+
+# ---------- Telegram webhook (BOT_MODE=webhook) ----------
+# Апдейты обрабатывает тот же Dispatcher, что и в polling (bot.build_dispatcher), прямо в
+# uvicorn-воркерах: сколько воркеров — столько процессов разбирают апдейты. FSM — в БД (SqlStorage),
+# фоновые задачи бота (outbox, chat_member, рассылки) — в каждом воркере, они к этому готовы.
+
+async def _start_webhook() -> None:
+    import bot as tg
+    from fsm_storage import SqlStorage
+    from write_behind import WRITE_BEHIND
+
+    if not settings.WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET")
+    if engine.dialect.name == "sqlite":
+        log.warning("BOT_MODE=webhook on SQLite: updates of one user are ordered only within a worker")
+    bot = tg.build_bot()
+    dp = tg.build_dispatcher(SqlStorage())
+    app.state.bot, app.state.dp = bot, dp
+    app.state.bot_tasks = tg.start_background(bot, single_process=False)
+    app.state.write_behind = WRITE_BEHIND
+
+    url = settings.WEBHOOK_URL or f"{settings.PUBLIC_BASE}{settings.WEBHOOK_PATH}"
+    try:
+        # каждый воркер проверяет сам; setWebhook зовём, только если адрес другой
+        info = await bot.get_webhook_info()
+        if info.url != url or info.max_connections != settings.WEBHOOK_MAX_CONNECTIONS:
+            await bot.set_webhook(
+                url, secret_token=settings.WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+            )
+    except Exception:
+        log.exception("set_webhook failed")
+
+
+async def _stop_webhook() -> None:
+    for task in app.state.bot_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.bot_tasks, return_exceptions=True)
+    await app.state.write_behind.close()
+    await app.state.bot.session.close()
+
+
+@app.post(settings.WEBHOOK_PATH)
+async def tg_webhook(request: Request):
+    if settings.BOT_MODE != "webhook":
+        raise HTTPException(status_code=404, detail="not found")
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, settings.WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+    from aiogram.types import Update
+    bot, dp = app.state.bot, app.state.dp
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+
+    # отвечаем после хендлера, как aiogram SimpleRequestHandler: не отвеченный апдейт Telegram
+    # пришлёт снова (рестарт воркера его не теряет), следующий апдейт чата — только после этого,
+    # а одновременно в обработке не больше WEBHOOK_MAX_CONNECTIONS
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        # как и в polling: упавший хендлер логируем, апдейт повторно не разбираем
+        log.exception("update %s failed", update.update_id)
+    return {"ok": True}
@@ -0,0 +1,248 @@
+"""
+Проверка подписки на канал с кэшем.
+
+get_chat_member медленный и лимитированный, а дёргаем его из evaluate_and_route,
+кнопки «Я подписался» и воркера постбэков. Результат кэшируется на пользователя
+(отдельные TTL для «подписан» и «не подписан»), параллельные проверки одного
+пользователя сливаются в один запрос (single-flight).
+
+Дополнительно бот получает chat_member-апдейты канала: изменения членства копятся в буфере
+и пишутся в users.is_subscribed пачками (MembershipBuffer), кэш обновляется сразу.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from sqlalchemy import select, update
+
+from broadcast import TokenBucket
+from config_service import ensure_config, cfg_int
+from db import get_session, User, USER_CACHE, bump_funnel, publish_user_invalidation
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+MEMBER_STATUSES = {"member", "administrator", "creator"}
+
+# {(channel_id, tg_id): (is_member, expires_at)}
+SUB_CACHE: Dict[Tuple[int, int], Tuple[bool, float]] = {}
+# запросы в полёте: {(channel_id, tg_id): future}
+_INFLIGHT: Dict[Tuple[int, int], asyncio.Future] = {}
+
+
+async def resolved_channel_id() -> Optional[int]:
+    await ensure_config()
+    return cfg_int("CHANNEL_ID", None)
+
+
+def remember_subscription(cid: int, tg_id: int, is_member: bool) -> None:
+    ttl = settings.SUB_CACHE_TTL if is_member else settings.SUB_CACHE_NEG_TTL
+    if len(SUB_CACHE) >= settings.SUB_CACHE_MAX:
+        now = time.monotonic()
+        for key in [k for k, (_, exp) in SUB_CACHE.items() if exp <= now]:
+            SUB_CACHE.pop(key, None)
+        # живых записей всё равно слишком много — выбрасываем самые старые (dict хранит порядок
+        # записи) с запасом в 10%, чтобы полный проход выше не повторялся на каждом вызове
+        keep = settings.SUB_CACHE_MAX * 9 // 10
+        for key in list(itertools.islice(SUB_CACHE, max(len(SUB_CACHE) - keep, 0))):
+            SUB_CACHE.pop(key, None)
+    key = (cid, tg_id)
+    # перезапись переносит ключ в конец — порядок словаря остаётся порядком записи
+    SUB_CACHE.pop(key, None)
+    SUB_CACHE[key] = (is_member, time.monotonic() + ttl)
+
+
+def cached_subscription(cid: int, tg_id: int) -> Optional[bool]:
+    hit = SUB_CACHE.get((cid, tg_id))
+    if hit is None or hit[1] <= time.monotonic():
+        return None
+    return hit[0]
+
+
+def forget_subscription(tg_id: int) -> None:
+    for key in [k for k in SUB_CACHE if k[1] == tg_id]:
+        SUB_CACHE.pop(key, None)
+
+
+async def _fetch(bot: Bot, cid: int, tg_id: int) -> Optional[bool]:
+    """None — ошибка API; такой результат не кэшируем."""
+    try:
+        member = await bot.get_chat_member(cid, tg_id)
+    except Exception:
+        return None
+    return getattr(member, "status", None) in MEMBER_STATUSES
+
+
+async def check_subscription(bot: Bot, tg_id: int, fresh: bool = False) -> bool:
+    """
+    fresh=True — пользователь сам нажал «Я подписался»: отрицательный кэш игнорируем,
+    положительный по-прежнему используем.
+    """
+    cid = await resolved_channel_id()
+    if not cid:
+        return False
+
+    hit = cached_subscription(cid, tg_id)
+    if hit or (hit is False and not fresh):
+        return hit
+
+    key = (cid, tg_id)
+    fut = _INFLIGHT.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        result = await _fetch(bot, cid, tg_id)
+        if result is not None:
+            remember_subscription(cid, tg_id, result)
+        fut.set_result(bool(result))
+        return bool(result)
+    finally:
+        _INFLIGHT.pop(key, None)
+        if not fut.done():
+            fut.set_result(False)
+
+
+# ========= push-обновления членства (chat_member) =========
+
+OnJoined = Callable[[List[int]], Awaitable[None]]
+
+
+async def _set_subscribed(s, tg_ids: List[int], value: bool) -> List[int]:
+    """
+    Переключает is_subscribed только у тех, у кого он действительно другой, и двигает
+    счётчики воронки по группам в той же транзакции. Возвращает id перевернувшихся.
+    """
+    if not tg_ids:
+        return []
+    res = await s.execute(
+        update(User)
+        .where(User.telegram_id.in_(tg_ids), User.is_subscribed == (not value))
+        .values(is_subscribed=value)
+        .returning(User.id, User.group_ab, User.telegram_id)
+        .execution_options(synchronize_session=False)
+    )
+    rows = res.all()
+    per_group: Dict[str, int] = {}
+    for _uid, group, _tg_id in rows:
+        per_group[group] = per_group.get(group, 0) + (1 if value else -1)
+    for group, delta in per_group.items():
+        await bump_funnel(s, group, {"subscribed": delta})
+    # UPDATE мимо ORM — снимки в LRU других процессов тоже устарели
+    await publish_user_invalidation(s, *(tg_id for _uid, _group, tg_id in rows))
+    return [uid for uid, _group, _tg_id in rows]
+
+
+class MembershipBuffer:
+    """
+    Копит события членства {tg_id: is_member} и раз в SUB_FLUSH_INTERVAL пишет их
+    двумя UPDATE ... WHERE telegram_id IN (...). Для тех, кто реально стал подписчиком
+    (флаг перевернулся), вызывается on_joined со списком users.id — в отдельной задаче через
+    ограниченную очередь: запись членства не ждёт пушей в Telegram.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[int, bool] = {}
+
+    def push(self, tg_id: int, is_member: bool) -> None:
+        self.pending[tg_id] = is_member
+
+    async def flush(self) -> List[int]:
+        if not self.pending:
+            return []
+        batch, self.pending = self.pending, {}
+        joined = [tg for tg, m in batch.items() if m]
+        left = [tg for tg, m in batch.items() if not m]
+        try:
+            async with get_session() as s:
+                flipped = await _set_subscribed(s, joined, True)
+                await _set_subscribed(s, left, False)
+                await s.commit()
+        except Exception:
+            # вернуть в буфер до следующего flush, не затирая более свежие события
+            self.pending = {**batch, **self.pending}
+            raise
+        USER_CACHE.invalidate(*batch)
+        return flipped
+
+    async def run(self, on_joined: OnJoined) -> None:
+        joined: asyncio.Queue = asyncio.Queue(maxsize=settings.SUB_JOINED_QUEUE)
+        router = asyncio.create_task(_route_joined(joined, on_joined))
+        try:
+            while True:
+                await asyncio.sleep(settings.SUB_FLUSH_INTERVAL)
+                try:
+                    flipped = await self.flush()
+                except Exception:
+                    log.exception("membership flush failed")
+                    continue
+                if not flipped:
+                    continue
+                try:
+                    joined.put_nowait(flipped)
+                except asyncio.QueueFull:
+                    # флаг уже записан — экран пользователь получит при следующем своём апдейте
+                    log.warning("joined queue full, %d users not routed", len(flipped))
+        finally:
+            router.cancel()
+
+
+async def _route_joined(queue: asyncio.Queue, on_joined: OnJoined) -> None:
+    while True:
+        user_ids = await queue.get()
+        try:
+            await on_joined(user_ids)
+        except Exception:
+            log.exception("routing joined users failed")
+
+
+MEMBERSHIP = MembershipBuffer()
+
+
+async def reconcile_subscriptions(bot: Bot) -> Tuple[int, int]:
+    """
+    Разовая сверка: проходим всех пользователей keyset-пачками, спрашиваем get_chat_member
+    с ограничением скорости и пишем расхождения пачкой. Возвращает (проверено, исправлено).
+    """
+    cid = await resolved_channel_id()
+    if not cid:
+        return 0, 0
+    limiter = TokenBucket(settings.SUB_BACKFILL_RATE)
+    checked = fixed = 0
+    last = 0
+    while True:
+        async with get_session() as s:
+            res = await s.execute(
+                select(User.id, User.telegram_id, User.is_subscribed)
+                .where(User.id > last).order_by(User.id).limit(settings.BCAST_BATCH)
+            )
+            rows = res.all()
+        if not rows:
+            break
+        last = rows[-1][0]
+        to_true: List[int] = []
+        to_false: List[int] = []
+        for _uid, tg_id, is_sub in rows:
+            await limiter.acquire()
+            result = await _fetch(bot, cid, tg_id)
+            if result is None:
+                continue
+            checked += 1
+            remember_subscription(cid, tg_id, result)
+            if result != bool(is_sub):
+                (to_true if result else to_false).append(tg_id)
+        if to_true or to_false:
+            async with get_session() as s:
+                await _set_subscribed(s, to_true, True)
+                await _set_subscribed(s, to_false, False)
+                await s.commit()
+            USER_CACHE.invalidate(*to_true, *to_false)
+            fixed += len(to_true) + len(to_false)
+    return checked, fixed
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 
 # Локализованные строки (только чешский)
 T: Dict[str, Dict[str, str]] = {
@@ -63,6 +63,19 @@ T: Dict[str, Dict[str, str]] = {
     'deposit_left': {'cs': 'Zbývá vložit'},
 }
 
+# Экран -> (ключ заголовка, ключ текста); общий для бота, админки и каталога контента
+SCREEN_MAP: Dict[str, Tuple[str, str]] = {
+    'main': ('main_title', 'main_desc'),
+    'instruction': ('instruction_title', 'instruction_text'),
+    'subscribe': ('subscribe_title', 'subscribe_text'),
+    'register': ('register_title', 'register_text'),
+    'deposit': ('deposit_title', 'deposit_text'),
+    'access': ('access_title', 'access_text'),
+    'platinum': ('platinum_title', 'platinum_text'),
+    'admin': ('main_title', 'main_desc'),
+    'langs': ('lang_title', 'lang_title'),
+}
+
 def t(_lang: str, key: str) -> str:
     """
     Возвращает строку только на чешском.
@@ -0,0 +1,115 @@
+"""
+Отложенная запись (write-behind) некритичных колонок users.
+
+last_bot_message_id меняется после каждого сообщения бота, access_notified — после пуша доступа;
+каждая такая мелочь — отдельный коммит с fsync. При WRITE_BEHIND=1 изменения копятся в памяти
+(последнее значение на пользователя и колонку) и пишутся одной транзакцией раз в
+WRITE_BEHIND_INTERVAL_MS или при WRITE_BEHIND_MAX_ROWS пользователях в очереди, плюс при остановке.
+
+Критичные записи (депозиты, флаги постбэка, подписка) сюда не попадают — они синхронные.
+Потеря очереди при падении процесса = лишнее удаление/повторный пуш, не деньги.
+"""
+import asyncio
+import logging
+from typing import Any, Dict
+
+from sqlalchemy import update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db import get_session, User, USER_CACHE
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+# только эти колонки можно писать отложенно
+DEFERRABLE = {"last_bot_message_id", "access_notified"}
+
+
+class WriteBehind:
+    def __init__(self, enabled: bool, interval: float, max_rows: int):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_rows = max_rows
+        self.pending: Dict[int, Dict[str, Any]] = {}   # user.id -> {колонка: значение}
+        self.commits = 0
+        self._kick = asyncio.Event()
+
+    def set(self, user: User, **values: Any) -> None:
+        """
+        Меняет колонки пользователя: отложенно (если включено) или обычным присваиванием
+        (тогда запишет коммит сессии, к которой привязан user).
+        """
+        if not self.enabled:
+            for key, value in values.items():
+                setattr(user, key, value)
+            return
+        if not DEFERRABLE.issuperset(values):
+            raise ValueError(f"not deferrable: {sorted(set(values) - DEFERRABLE)}")
+        for key, value in values.items():
+            # объект и LRU видят новое значение сразу, но сессия не считает его грязным
+            set_committed_value(user, key, value)
+        USER_CACHE.apply(user.telegram_id, values)
+        self.pending.setdefault(user.id, {}).update(values)
+        if len(self.pending) >= self.max_rows:
+            self._kick.set()
+
+    def value(self, user: User, key: str) -> Any:
+        """Значение колонки с учётом ещё не записанной очереди."""
+        pending = self.pending.get(user.id)
+        if pending and key in pending:
+            return pending[key]
+        return getattr(user, key)
+
+    def discard(self, user_id: int, *keys: str) -> None:
+        """Снимает отложенные значения (например, админ сбрасывает флаг синхронно)."""
+        pending = self.pending.get(user_id)
+        if not pending:
+            return
+        for key in keys:
+            pending.pop(key, None)
+        if not pending:
+            self.pending.pop(user_id, None)
+
+    async def flush(self) -> int:
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        try:
+            async with get_session() as s:
+                # ORM bulk UPDATE по первичному ключу: executemany, одна транзакция
+                await s.execute(update(User), [{"id": uid, **values} for uid, values in batch.items()])
+                await s.commit()
+        except Exception:
+            # вернуть в очередь, не затирая более свежие значения
+            for uid, values in batch.items():
+                self.pending[uid] = {**values, **self.pending.get(uid, {})}
+            raise
+        self.commits += 1
+        return len(batch)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("write-behind flush failed")
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("write-behind final flush failed")
+
+
+# в режиме webhook апдейты пользователя разбирают разные процессы: очередь одного из них
+# другие не видят и читали бы из БД старый last_bot_message_id — там пишем синхронно
+WRITE_BEHIND = WriteBehind(
+    settings.WRITE_BEHIND and settings.BOT_MODE != "webhook",
+    settings.WRITE_BEHIND_INTERVAL_MS / 1000.0,
+    settings.WRITE_BEHIND_MAX_ROWS,
+)